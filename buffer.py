@@ -1,259 +1,326 @@
 import datetime
 import os
 import pickle
+import threading
+from collections import deque
 
-from functools import reduce
-from operator import add
-
-import torch
 import ray
 
 import numpy as np
 
+from memory import CounterSubscriber, value_priorities
+from replay_store import ReplayStore
+from sum_tree import SumTree
+
 
 @ray.remote
-class Buffer:
-    def __init__(self, config, memory):
+class Buffer(CounterSubscriber):
+    def __init__(self, config, memory, shard=0):
         self.config = config
         self.memory = memory
-        self.image_size = config["full_image_size"]
+        # With buffer_shards above 1, this is one of several buffers splitting the games between them, see ShardedBuffer
+        self.shard = shard
+        self.n_shards = config["buffer_shards"]
 
         self.last_time = datetime.datetime.now()  # Used if profiling speed of batching
 
-        self.size = config["buffer_size"]  # How many game records to store
+        self.size = -(-config["buffer_size"] // self.n_shards)  # How many game records to store
         self.priority_alpha = config["priority_alpha"]
         self.initial_priority_beta = config["initial_priority_beta"]
         self.final_priority_beta = config["final_priority_beta"]
         self.max_total_frames = self.config["max_total_frames"]
         self.tau = config["tau"]
 
-        # List of start points of each game if the whole buffer were concatenated
-        self.game_starts_list = []
-
-        if self.config["load_buffer"] and os.path.exists(
-            os.path.join("buffers", config["env_name"])
-        ):
-            self.load_buffer()
-        else:
-            self.buffer = []
-            self.buffer_ndxs = []
+        # Every step saved to the buffer gets a global step index, counting up from 0. For each game in the buffer,
+        # oldest first, game_starts_list holds the global index of its first step, and buffer_ndxs its game number
+        self.game_starts_list = deque()
+        self.game_lengths = deque()
+        self.buffer_ndxs = deque()
+        self.last_analysed = deque()
+        self.index_games()
+        self.next_step = 0  # Global index of the next step to be saved
+        self.total_vals = 0  # Number of steps in the buffer
+
+        # The steps are stored in the columns of a ReplayStore, and their priorities, raised to priority_alpha,
+        # in a sum tree. Both are used as a ring of buffer_steps rows: the row of a step is its global index
+        # modulo the capacity, and the oldest games are removed before their rows are overwritten
+        self.capacity = config["buffer_steps"] // self.n_shards
+        assert self.capacity >= config["max_frames"], "each shard of buffer_steps must be able to hold a whole game"
+        self.store = ReplayStore(config, self.capacity)
+        self.priority_tree = SumTree(self.capacity)
 
         self.prioritized_replay = config["priority_replay"]
 
-        self.priorities = []
+        # The buffer is a threaded actor, building several batches at once for the trainer's prefetch queue,
+        # so the lock is held by anything reading or changing the stored games
+        self.lock = threading.RLock()
 
-    def save_buffer(self):
-        with open(os.path.join("buffers", self.config["env_name"]), "wb") as f:
-            pickle.dump((self.buffer, self.buffer_ndxs), f)
+        if self.config["load_buffer"] and os.path.exists(self.buffer_path()):
+            self.load_buffer()
 
-    def load_buffer(self):
-        with open(os.path.join("buffers", self.config["env_name"]), "rb") as f:
-            self.buffer, self.buffer_ndxs = pickle.load(f)
-        self.update_stats()
+    def index_games(self):
+        # Games are only added at the end and removed from the front, so a game keeps its position
+        # in the order of all games added, from which its index in the buffer is found
+        self.games_removed = 0
+        self.game_positions = {ndx: i for i, ndx in enumerate(self.buffer_ndxs)}
+        self.game_arrays = None
 
-    def update_vals(self, ndx, vals):
+    def buffer_slot(self, ndx):
+        """The index in the buffer of the game numbered ndx, raising a ValueError if it's not in the buffer"""
         try:
-            buf_ndx = self.buffer_ndxs.index(ndx)
-            self.buffer[buf_ndx].values = vals
-            total_games = ray.get(self.memory.get_total_games.remote())
-            self.buffer[buf_ndx].last_analysed = total_games
-        except ValueError:
-            print(f"No buffer item with index {ndx}")
+            return self.game_positions[ndx] - self.games_removed
+        except KeyError:
+            raise ValueError(f"Game {ndx} is not in the buffer")
 
-    def add_priorities(self, ndx, reanalysing=False):
-        try:
-            buf_ndx = self.buffer_ndxs.index(ndx)
-            self.buffer[buf_ndx].add_priorities(
-                n_steps=self.config["reward_depth"], reanalysing=reanalysing
-            )
-        except ValueError:
-            print(f"No buffer item with index {ndx}")
-
-    def update_stats(self):
-        # Maintain stats for the total length of all games in the buffer
-        # and where each game would begin if all games were concatenated
-        # so that each step of each game can be uniquely indexed
-
-        lengths = [len(x.values) for x in self.buffer]
-        self.game_starts_list = [sum(lengths[0:i]) for i in range(len(self.buffer))]
-        self.total_vals = sum(lengths)
-        self.priorities = reduce(add, [x.priorities for x in self.buffer], [])
-        self.priorities = [float(p**self.priority_alpha) for p in self.priorities]
-        sum_priorities = sum(self.priorities)
-        self.priorities = [p / sum_priorities for p in self.priorities]
-
-    def get_batch(self, batch_size=40, device=torch.device("cpu")):
-        self.print_timing("start")
-        rollout_depth = self.config["rollout_depth"]
-        batch = []
+    def get_game_arrays(self):
+        # The starts and lengths of the games as arrays, rebuilt only after games are added or removed
+        if self.game_arrays is None:
+            self.game_arrays = (np.array(self.game_starts_list), np.array(self.game_lengths))
+        return self.game_arrays
 
-        # Get a random list of points across the length of the buffer to take training examples
-        if self.prioritized_replay:
-            probabilities = self.priorities
-        else:
-            probabilities = None
+    def buffer_path(self):
+        name = self.config["env_name"] if self.n_shards == 1 else f"{self.config['env_name']}_{self.shard}"
+        return os.path.join("buffers", name)
 
-        if probabilities and len(probabilities) != self.total_vals:
-            breakpoint()
-        start_vals = np.random.choice(
-            list(range(self.total_vals)), size=batch_size, p=probabilities
-        )
-        self.print_timing("get ndxs")
+    def save_buffer(self):
+        game_lists = (self.game_starts_list, self.game_lengths, self.buffer_ndxs, self.last_analysed)
+        with open(self.buffer_path(), "wb") as f:
+            pickle.dump((self.store, game_lists, self.next_step), f)
 
-        images_a = np.zeros(
-            (batch_size, rollout_depth, *self.image_size), dtype=np.float32
-        )
-        if self.config["exp_name"]=="cartpole-nec":
-            renders_a = [None] * batch_size 
+    def load_buffer(self):
+        with open(self.buffer_path(), "rb") as f:
+            self.store, game_lists, self.next_step = pickle.load(f)
+        self.game_starts_list, self.game_lengths, self.buffer_ndxs, self.last_analysed = map(deque, game_lists)
+        self.index_games()
+        self.total_vals = sum(self.game_lengths)
+
+        for buf_ndx in range(len(self.buffer_ndxs)):
+            steps = self.game_steps(buf_ndx)
+            self.set_priorities(steps, self.store.priorities[self.store.rows(steps)])
+
+    def update_vals(self, ndx, vals, search_stats=None):
+        """Sets the values and search stats of a reanalysed game, and the priorities of its steps from these values"""
+        # The priorities are set under the same lock, as the calls to a threaded actor can run in any order
+        with self.lock:
+            # Only a game which has left the buffer is skipped, other errors being raised
+            try:
+                buf_ndx = self.buffer_slot(ndx)
+            except ValueError:
+                print(f"No buffer item with index {ndx}")
+                return
+            rows = self.store.rows(self.game_steps(buf_ndx))
+            self.store.set_values(rows, vals, search_stats)
+            self.last_analysed[buf_ndx] = self.counters["games"]
+            self.add_priorities(ndx, reanalysing=True)
 
-        if self.config["obs_type"] == "bipedalwalker":
-            actions_a = np.zeros((batch_size, rollout_depth, self.config["action_dim"]), dtype=np.int64)
-            target_policies_a = np.zeros(
-                (batch_size, rollout_depth, self.config["action_dim"], self.config["action_size"]), dtype=np.float32
-            )
+    def add_priorities(self, ndx, reanalysing=False):
+        with self.lock:
+            try:
+                buf_ndx = self.buffer_slot(ndx)
+            except ValueError:
+                print(f"No buffer item with index {ndx}")
+                return
+            steps = self.game_steps(buf_ndx)
+            values = self.store.values[self.store.rows(steps)]
+            self.set_priorities(steps, value_priorities(values, n_steps=self.config["reward_depth"]))
+
+    def update_priorities(self, steps, errors):
+        """
+        Sets the priorities of the steps with the given global indices to the value errors found for them
+        in training, in one update of the sum tree. Steps which have left the buffer since being sampled are skipped
+        """
+        with self.lock:
+            steps = np.asarray(steps, dtype=np.int64)
+            errors = np.asarray(errors, dtype=np.float64)
+            if not self.buffer_ndxs:
+                return
+            in_buffer = steps >= self.game_starts_list[0]
+            self.set_priorities(steps[in_buffer], errors[in_buffer])
+
+    def set_priorities(self, steps, priorities):
+        rows = self.store.rows(steps)
+        self.store.priorities[rows] = priorities
+        self.priority_tree.update(rows, np.asarray(priorities, dtype=np.float64)**self.priority_alpha)
+
+    def game_steps(self, buf_ndx):
+        start = self.game_starts_list[buf_ndx]
+        return np.arange(start, start + self.game_lengths[buf_ndx])
+
+    def add_game(self, game, ndx):
+        self.store.add_game(self.next_step, game)
+        self.game_starts_list.append(self.next_step)
+        self.game_lengths.append(len(game.values))
+        self.buffer_ndxs.append(ndx)
+        self.last_analysed.append(game.last_analysed)
+        self.game_positions[ndx] = self.games_removed + len(self.buffer_ndxs) - 1
+        self.game_arrays = None
+        self.next_step += len(game.values)
+        self.total_vals += len(game.values)
+        self.set_priorities(self.game_steps(len(self.buffer_ndxs) - 1), game.priorities)
+
+    def remove_oldest_game(self):
+        self.priority_tree.update(self.store.rows(self.game_steps(0)), 0)
+        self.total_vals -= self.game_lengths[0]
+        self.game_starts_list.popleft()
+        self.game_lengths.popleft()
+        del self.game_positions[self.buffer_ndxs.popleft()]
+        self.last_analysed.popleft()
+        self.games_removed += 1
+        self.game_arrays = None
+
+    def sample_steps(self, batch_size):
+        """
+        Samples the global indices of batch_size steps, in proportion to their priority with prioritized replay,
+        returning these with the probability with which each was sampled
+        """
+        first_step = self.game_starts_list[0]
+        if self.prioritized_replay:
+            total_priority = self.priority_tree.total()
+            leaves = self.priority_tree.find(np.random.uniform(0, total_priority, size=batch_size))
+            probabilities = self.priority_tree.get(leaves) / total_priority
+            # Recover the global index of each step from its leaf, knowing that the steps in the buffer
+            # are the capacity (or fewer) consecutive steps from first_step
+            steps = first_step + (leaves - first_step) % self.capacity
         else:
-            actions_a = np.zeros((batch_size, rollout_depth), dtype=np.int64)
-            target_policies_a = np.zeros(
-                (batch_size, rollout_depth, self.config["action_size"]), dtype=np.float32
-            )
-
-        target_values_a = np.zeros((batch_size, rollout_depth), dtype=np.float32)
-        target_rewards_a = np.zeros((batch_size, rollout_depth), dtype=np.float32)
-        
-        weights_a = np.zeros(batch_size, dtype=np.float32)
-        depths_a = np.zeros(batch_size, dtype=np.int64)
-
-        for i, val in enumerate(start_vals):
-            # Get the index of the game in the buffer (game_ndx) and a location in the game (frame_ndx)
-            game_ndx, frame_ndx = self.get_ndxs(val)
+            steps = np.random.randint(first_step, self.next_step, size=batch_size)
+            probabilities = np.full(batch_size, 1 / self.total_vals)
+        return steps, probabilities
+
+    def get_sampling_total(self):
+        """The total of the priorities (raised to priority_alpha) with prioritized replay, else the number of steps"""
+        with self.lock:
+            return self.priority_tree.total() if self.prioritized_replay else self.total_vals
+
+    def get_batch(self, batch_size=40, shard_probability=1.0):
+        """
+        Samples a batch of targets, where shard_probability is the probability with which each of the samples
+        was given to this shard, for the importance weights. The weights are normalised by ShardedBuffer,
+        once the batches of all of the shards are put together
+        """
+        self.print_timing("start")
 
-            game = self.buffer[game_ndx]
+        # The steps are sampled under the lock, but their targets are gathered outside of it, so that the batches
+        # being prefetched are built concurrently. A game saved meanwhile overwrites the rows of the oldest steps,
+        # so a batch which reached into these is sampled again
+        while True:
+            with self.lock:
+                # Get a random list of points across the length of the buffer to take training examples
+                start_vals, probabilities = self.sample_steps(batch_size)
+                self.print_timing("get ndxs")
 
-            reward_depth = self.get_reward_depth(
-                val,
-                self.tau,
-                self.config["total_training_steps"],
-                self.config["reward_depth"],
-            )
+                game_ndxs = self.game_ndxs(start_vals)
+                game_starts, game_lengths = self.get_game_arrays()
+                sample_starts, sample_lengths = game_starts[game_ndxs], game_lengths[game_ndxs]
 
-            # Gets a series of actions, values, rewards, policies, up to a depth of rollout_depth
+            # Gets a series of actions, values, rewards, policies, up to a depth of rollout_depth, for every sample
             (
-                images,
-                actions,
-                target_values,
-                target_rewards,
-                target_policies,
-                depth,
-            ) = game.make_target(
-                frame_ndx,
+                images_a,
+                actions_a,
+                target_values_a,
+                target_rewards_a,
+                target_policies_a,
+                depths_a,
+            ) = self.store.make_targets(
+                start_vals,
+                sample_starts,
+                sample_lengths,
                 reward_depth=self.config["reward_depth"],
                 rollout_depth=self.config["rollout_depth"],
             )
+            self.print_timing("make_targets")
 
-            # Add tuple to batch
-            if self.prioritized_replay:
-                total_frames = ray.get(self.memory.get_total_frames.remote())
-                self.priority_beta = self.initial_priority_beta + \
-                                        total_frames/self.max_total_frames * \
-                                        (self.final_priority_beta - self.initial_priority_beta)
-                weight = (1 / self.priorities[val])**self.priority_beta
-            else:
-                weight = 1
-
-            if self.config["exp_name"]=="cartpole-nec":
-                renders_a[i] = images[1]
-                images_a[i] = images[0]
-            else:
-                images_a[i] = images
-
-            actions_a[i] = actions
-            target_values_a[i] = target_values
-            target_rewards_a[i] = target_rewards
-            target_policies_a[i] = target_policies
-
-            weights_a[i] = weight
-            depths_a[i] = depth
-        self.print_timing("make_lists")
+            with self.lock:
+                if (sample_starts >= self.next_step - self.capacity).all():
+                    break
+
+        if self.prioritized_replay:
+            total_frames = self.counters["frames"]
+            self.priority_beta = self.initial_priority_beta + \
+                                    total_frames/self.max_total_frames * \
+                                    (self.final_priority_beta - self.initial_priority_beta)
+            weights_a = (1 / (shard_probability * probabilities))**self.priority_beta
+        else:
+            weights_a = np.ones(batch_size)
 
         if self.config["exp_name"]=="cartpole-nec":
-            images_t = (torch.tensor(images_a, dtype=torch.float32, device=device), renders_a)
+            images_a, renders_a = images_a
+            images_a = (images_a.astype(np.float32, copy=False), renders_a)
         else:
-            images_t = torch.tensor(images_a, dtype=torch.float32, device=device)
-        actions_t = torch.tensor(actions_a, dtype=torch.int64, device=device)
-        target_values_t = torch.tensor(
-            target_values_a, dtype=torch.float32, device=device
-        )
-        target_policies_t = torch.tensor(
-            target_policies_a, dtype=torch.float32, device=device
-        )
-        target_rewards_t = torch.tensor(
-            target_rewards_a, dtype=torch.float32, device=device
-        )
-        weights_t = torch.tensor(weights_a, dtype=torch.float32, device=device)
-        weights_t = weights_t / max(weights_t)
-        self.print_timing("make_tensors")
+            images_a = images_a.astype(np.float32, copy=False)
+        self.print_timing("make_arrays")
+
+        # The batch is returned as numpy arrays, which Ray passes to the trainer through its shared memory
+        # object store without copying or pickling them, for the trainer to wrap as tensors
         return (
-            images_t,
-            actions_t,
-            target_values_t,
-            target_rewards_t,
-            target_policies_t,
-            weights_t,
+            images_a,
+            actions_a,
+            target_values_a.astype(np.float32),
+            target_rewards_a.astype(np.float32),
+            target_policies_a.astype(np.float32, copy=False),
+            weights_a.astype(np.float32),
             depths_a,
+            start_vals,
         )
 
     def get_buffer_ndx(self, ndx):
-        buf_ndx = self.buffer_ndxs.index(ndx)
-        return self.buffer[buf_ndx]
+        with self.lock:
+            buf_ndx = self.buffer_slot(ndx)
+            return self.store.game_record(
+                self.game_starts_list[buf_ndx], self.game_lengths[buf_ndx], self.last_analysed[buf_ndx]
+            )
 
-    def get_buffer_len(self):
-        return len(self.buffer)
+    def get_observations(self, ndx):
+        """The observations of every step of a game, as taken by the network, for reanalysing it"""
+        with self.lock:
+            buf_ndx = self.buffer_slot(ndx)
+            steps = self.game_steps(buf_ndx)
+            return self.store.get_observations(steps, np.full(len(steps), steps[0]))
 
-    def get_buffer(self):
-        return self.buffer
+    def get_buffer_len(self):
+        return len(self.buffer_ndxs)
 
     def get_buffer_ndxs(self):
-        return self.buffer_ndxs
+        with self.lock:
+            return list(self.buffer_ndxs)
 
-    def get_reanalyse_probabilities(self):
-        total_games = ray.get(self.memory.get_total_games.remote())
-        p = np.array([total_games - x.last_analysed for x in self.buffer]).astype(
-            np.float32
-        )
-        if sum(p) > 0:
-            return p / sum(p)
-        else:
-            return np.array([])
+    def get_reanalyse_weights(self):
+        """The numbers of the games in the buffer, with how many games have been played since each was analysed"""
+        with self.lock:
+            total_games = self.counters["games"]
+            return list(self.buffer_ndxs), [total_games - x for x in self.last_analysed]
 
     def save_game(self, game, n_frames, score, game_data):
-        # If reached the max size, remove the oldest GameRecord, and update stats accordingly
-        while len(self.buffer) >= self.size:
-            self.buffer.pop(0)
-            self.buffer_ndxs.pop(0)
-
-        self.buffer.append(game)
-        self.update_stats()
-        # self.save_buffer()
-        self.buffer_ndxs.append(game_data["games"] - 1)
+        with self.lock:
+            # If reached the max size, or the steps of the game won't fit, remove the oldest games
+            while self.buffer_ndxs and (
+                len(self.buffer_ndxs) >= self.size
+                or self.total_vals + len(game.values) > self.capacity
+            ):
+                self.remove_oldest_game()
+
+            self.add_game(game, game_data["games"] - 1)
+            # self.save_buffer()
+
+    def game_ndxs(self, steps):
+        """The index in the buffer of the game of each of the global indices steps, the last game to start at or before it"""
+        game_starts, _ = self.get_game_arrays()
+        return np.searchsorted(game_starts, steps, side="right") - 1
 
     def get_ndxs(self, val):
-        if val >= self.total_vals:
+        # val is the global index of a step
+        if val >= self.next_step:
             raise ValueError("Trying to get a value beyond the length of the buffer")
 
-        # Assumes len_list is sorted, gets the last entry in starts_list which is below val
-        # by iterating through game_starts_list until one is above val, at which point
-        # it returns the previous value in game_starts_list
-        # and the position in the game is gap between the game's start position and val
-        for i, l in enumerate(self.game_starts_list):
-            if l > val:
-                return i - 1, val - self.game_starts_list[i - 1]
-        return len(self.buffer) - 1, val - self.game_starts_list[-1]
+        # Returns the index of the game in the buffer, and the position in the game, the gap between the
+        # game's start position and val
+        game_ndx = int(self.game_ndxs(val))
+        return game_ndx, val - self.game_starts_list[game_ndx]
 
     def get_reward_depth(self, val, tau=0.3, total_steps=100_000, max_depth=5):
         if self.config["off_policy_correction"]:
             # Varying reward depth depending on the length of time since the trajectory was generated
             # Follows the formula in A.4 of EfficientZero paper
-            steps_ago = self.total_vals - val
+            steps_ago = self.next_step - val
             depth = max_depth - np.floor((steps_ago / (tau * total_steps)))
             depth = int(np.clip(depth, 1, max_depth))
         else:
@@ -265,3 +332,121 @@ class Buffer:
             now = datetime.datetime.now()
             print(f"{tag:20} {now - self.last_time}")
             self.last_time = now
+
+
+class ShardedBuffer:
+    """
+    Spreads the games over several Buffer actors, so that batches are built on as many cores, game number ndx
+    going to shard ndx % n_shards. The player, trainer and reanalyser use this in place of a single Buffer.
+
+    A batch is split between the shards by drawing the number of samples from each in proportion to its total
+    priority (or number of steps), so each step is sampled with the same probability as from a single buffer.
+    The global step indices of the samples are encoded as step * n_shards + shard.
+
+    The totals of the shards are cached, and refreshed by calls kept in flight, so that requesting a batch
+    doesn't wait on the shards. The importance weights use the probabilities the batch was split with,
+    so they stay exact even when the cached totals are slightly behind.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.n_shards = len(shards)
+        self.totals = None
+        self.total_refs = None
+
+    def game_shard(self, ndx):
+        return self.shards[ndx % self.n_shards]
+
+    def save_game(self, game, n_frames, score, game_data):
+        self.game_shard(game_data["games"] - 1).save_game.remote(game, n_frames, score, game_data)
+
+    def update_vals(self, ndx, vals, search_stats=None):
+        self.game_shard(ndx).update_vals.remote(ndx=ndx, vals=vals, search_stats=search_stats)
+
+    def update_priorities(self, steps, errors):
+        shards, steps = np.asarray(steps) % self.n_shards, np.asarray(steps) // self.n_shards
+        for shard in np.unique(shards):
+            in_shard = shards == shard
+            self.shards[shard].update_priorities.remote(steps[in_shard], np.asarray(errors)[in_shard])
+
+    def get_observations(self, ndx):
+        return ray.get(self.game_shard(ndx).get_observations.remote(ndx))
+
+    def get_buffer_ndx(self, ndx):
+        return ray.get(self.game_shard(ndx).get_buffer_ndx.remote(ndx))
+
+    def get_buffer_len(self):
+        return sum(ray.get([shard.get_buffer_len.remote() for shard in self.shards]))
+
+    def get_buffer_ndxs(self):
+        return [ndx for ndxs in ray.get([shard.get_buffer_ndxs.remote() for shard in self.shards]) for ndx in ndxs]
+
+    def get_reanalyse_probabilities(self):
+        """The numbers of the games in the buffers, and the probability of reanalysing each, an empty array if none"""
+        shard_weights = ray.get([shard.get_reanalyse_weights.remote() for shard in self.shards])
+        ndxs = [ndx for shard_ndxs, _ in shard_weights for ndx in shard_ndxs]
+        p = np.array([w for _, weights in shard_weights for w in weights]).astype(np.float32)
+        if sum(p) > 0:
+            return ndxs, p / sum(p)
+        else:
+            return ndxs, np.array([])
+
+    def request_batch(self, batch_size):
+        """Starts building a batch, returning the requests to the shards to be passed to get_batch"""
+        self.refresh_totals()
+        shard_probabilities = self.totals / self.totals.sum()
+        sizes = np.random.multinomial(batch_size, shard_probabilities)
+        return [
+            (shard, self.shards[shard].get_batch.remote(batch_size=size, shard_probability=shard_probabilities[shard]))
+            for shard, size in enumerate(sizes)
+            if size > 0
+        ]
+
+    def refresh_totals(self):
+        """Takes the totals of the shards which have answered since the last refresh, asking them again"""
+        if self.totals is None:
+            # Only the first request waits for the totals
+            self.totals = np.array(ray.get([shard.get_sampling_total.remote() for shard in self.shards]))
+            self.total_refs = [shard.get_sampling_total.remote() for shard in self.shards]
+            return
+
+        ready, _ = ray.wait(self.total_refs, num_returns=self.n_shards, timeout=0)
+        ready = set(ready)
+        for shard, ref in enumerate(self.total_refs):
+            if ref in ready:
+                self.totals[shard] = ray.get(ref)
+                self.total_refs[shard] = self.shards[shard].get_sampling_total.remote()
+
+    def batch_ready(self, requests):
+        ready, _ = ray.wait([ref for _, ref in requests], num_returns=len(requests), timeout=0)
+        return len(ready) == len(requests)
+
+    def get_batch(self, requests):
+        """Puts together the batches from the shards, in the same form as Buffer.get_batch returns one"""
+        batches = ray.get([ref for _, ref in requests])
+        images, actions, target_values, target_rewards, target_policies, weights, depths, steps = zip(*batches)
+
+        if isinstance(images[0], tuple):
+            # With NEC the images come with the renders of each sample
+            images = (join_arrays([ims for ims, _ in images]), [r for _, renders in images for r in renders])
+        else:
+            images = join_arrays(images)
+        weights = join_arrays(weights)
+        steps = join_arrays(
+            [shard_steps * self.n_shards + shard for (shard, _), shard_steps in zip(requests, steps)]
+        )
+        return (
+            images,
+            join_arrays(actions),
+            join_arrays(target_values),
+            join_arrays(target_rewards),
+            join_arrays(target_policies),
+            weights / weights.max(),
+            join_arrays(depths),
+            steps,
+        )
+
+
+def join_arrays(arrays):
+    # A batch from a single shard is passed on as it is, keeping the views of the object store
+    return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
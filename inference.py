@@ -0,0 +1,198 @@
+import asyncio
+import copy
+import time
+from collections import deque
+
+import numpy as np
+import ray
+import torch
+
+from torch.utils.tensorboard import SummaryWriter
+
+from models import MuZeroBipedalNet
+
+
+@ray.remote
+class InferenceServer:
+    """
+    Owns the model used by the searches of the player and the reanalyser, and runs their initial
+    and recurrent inference requests. Requests arriving within inference_max_wait seconds of the first
+    pending one are coalesced into a single forward pass, of up to inference_max_batch samples.
+
+    This is an async actor, so requests from many clients are in flight at once while they wait
+    for their batch. The latest model is reloaded from memory every inference_reload_interval seconds.
+    """
+
+    def __init__(self, config, mu_net, log_dir, memory, device=torch.device("cpu")):
+        self.config = config
+        self.log_dir = log_dir
+        self.memory = memory
+        self.device = device
+        self.mu_net = mu_net.to(device)
+        self.mu_net.eval()
+
+        self.max_wait = config["inference_max_wait"]
+        self.max_batch = config["inference_max_batch"]
+        self.reload_interval = config["inference_reload_interval"]
+        self.last_reload = time.time()
+        self.reloading = False
+
+        # Requests waiting to be batched, as (inputs, future, arrival time), for each kind of inference
+        self.pending = {"initial": [], "recurrent": []}
+        self.flush_tasks = {}
+
+        self.batch_sizes = deque(maxlen=10_000)
+        self.latencies = deque(maxlen=10_000)  # Seconds from the arrival of each request to its result
+        self.n_batches = 0
+        self.writer = SummaryWriter(log_dir=log_dir)
+
+    async def initial_inference(self, frames_t):
+        return await self.submit("initial", frames_t)
+
+    async def recurrent_inference(self, latents, actions_t, lstm_hiddens=None):
+        return await self.submit("recurrent", latents, actions_t, lstm_hiddens)
+
+    async def submit(self, kind, *inputs):
+        if not self.reloading and time.time() - self.last_reload > self.reload_interval:
+            self.reloading = True
+            asyncio.ensure_future(self.reload_model())
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[kind].append((inputs, future, time.perf_counter()))
+
+        n_pending = sum(len(inputs[0]) for inputs, _, _ in self.pending[kind])
+        if n_pending >= self.max_batch:
+            self.run_batch(kind)
+        elif kind not in self.flush_tasks:
+            self.flush_tasks[kind] = asyncio.ensure_future(self.flush_later(kind))
+        return await future
+
+    async def flush_later(self, kind):
+        await asyncio.sleep(self.max_wait)
+        self.flush_tasks.pop(kind, None)
+        if self.pending[kind]:
+            self.run_batch(kind)
+
+    async def reload_model(self):
+        # The model is loaded into a copy, which is only swapped in once it is on the device,
+        # as batches keep running on the current model while it loads
+        try:
+            mu_net = await self.memory.load_model.remote(self.log_dir, copy.deepcopy(self.mu_net).cpu())
+            mu_net = mu_net.to(self.device)
+            mu_net.eval()
+            self.mu_net = mu_net
+        finally:
+            self.last_reload = time.time()
+            self.reloading = False
+
+    def run_batch(self, kind):
+        requests, self.pending[kind] = self.pending[kind], []
+        # The timer of the requests being run is cancelled, so the next requests start their own max_wait window
+        flush_task = self.flush_tasks.pop(kind, None)
+        if flush_task is not None:
+            flush_task.cancel()
+        sizes = [len(inputs[0]) for inputs, _, _ in requests]
+
+        try:
+            results = self.infer(kind, requests, sizes)
+        except Exception as e:
+            # Every request of the batch gets the error, rather than leaving their clients waiting forever
+            for _, future, _ in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        finish_time = time.perf_counter()
+        for (_, future, arrival_time), result in zip(requests, results):
+            future.set_result(result)
+            self.latencies.append(finish_time - arrival_time)
+
+        self.batch_sizes.append(sum(sizes))
+        self.n_batches += 1
+        if self.n_batches % 1000 == 0:
+            self.summarize()
+
+    def infer(self, kind, requests, sizes):
+        """Runs the inputs of the requests as one batch, returning the outputs of each request"""
+        with torch.no_grad():
+            if kind == "initial":
+                frames_t = torch.cat([inputs[0] for inputs, _, _ in requests]).to(self.device)
+                outputs = self.mu_net.initial_inference(frames_t)
+            else:
+                latents = torch.cat([inputs[0] for inputs, _, _ in requests]).to(self.device)
+                actions_t = torch.cat([inputs[1] for inputs, _, _ in requests]).to(self.device)
+                if self.config["value_prefix"]:
+                    # The hiddens are (num_layers, batch_size, hidden_size)
+                    lstm_hiddens = tuple(
+                        torch.cat([inputs[2][i] for inputs, _, _ in requests], dim=1).to(self.device)
+                        for i in range(2)
+                    )
+                else:
+                    lstm_hiddens = None
+                outputs = self.mu_net.recurrent_inference(latents, actions_t, lstm_hiddens)
+        return split_outputs(outputs, sizes)
+
+    def get_stats(self):
+        """Batch sizes and request latencies of the last 10,000 batches and requests"""
+        return {
+            "batch_sizes": np.array(self.batch_sizes),
+            "latencies": np.array(self.latencies),
+        }
+
+    def summarize(self):
+        self.writer.add_histogram("Inference/batch_size", np.array(self.batch_sizes), self.n_batches)
+        self.writer.add_histogram("Inference/latency", np.array(self.latencies), self.n_batches)
+
+
+def split_outputs(outputs, sizes):
+    """
+    Splits the outputs of a batched inference back into the results of each request,
+    given the batch size of each, with the tensors moved to the cpu to be sent back
+    """
+    results = [[] for _ in sizes]
+    for output in outputs:
+        if output is None:
+            parts = [None] * len(sizes)
+        elif isinstance(output, tuple):
+            # LSTM hiddens, whose batch dimension is the second
+            split = [torch.split(h.cpu(), sizes, dim=1) for h in output]
+            parts = list(zip(*split))
+        else:
+            parts = torch.split(output.cpu(), sizes)
+        for result, part in zip(results, parts):
+            result.append(part)
+    return [tuple(result) for result in results]
+
+
+class InferenceClient:
+    """
+    Stands in for the model in search, sending its inference requests to an InferenceServer.
+    It only holds what the search needs to know about the model besides its outputs.
+    """
+
+    def __init__(self, server, mu_net):
+        self.server = server
+        self.config = mu_net.config
+        self.action_size = mu_net.action_size
+        self.action_dim = getattr(mu_net, "action_dim", 1)
+        if isinstance(mu_net, MuZeroBipedalNet):
+            self.dim_action_values = mu_net.dim_action_values
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def initial_inference(self, frames_t):
+        return ray.get(self.server.initial_inference.remote(frames_t.cpu()))
+
+    def recurrent_inference(self, latents, actions_t, lstm_hiddens=None):
+        if lstm_hiddens is not None:
+            lstm_hiddens = tuple(h.cpu() for h in lstm_hiddens)
+        return ray.get(
+            self.server.recurrent_inference.remote(latents.cpu(), actions_t.cpu(), lstm_hiddens)
+        )
+
+    def decode_actions(self, actions):
+        return MuZeroBipedalNet.decode_actions(self, actions)
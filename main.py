@@ -15,11 +15,12 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 
 from trainer import Trainer
-from buffer import Buffer
+from buffer import Buffer, ShardedBuffer
 from player import Player
 from models import MuZeroCartNet, MuZeroNECCartNet, MuZeroBipedalNet, MuZeroAtariNet, TestNet
 from memory import GameRecord, Memory
 from reanalyser import Reanalyser
+from inference import InferenceServer, InferenceClient
 from envs import testgame_env, testgamed_env, atari_env, cartpole_env, bipedal_env
 
 
@@ -104,12 +105,18 @@ def run(config, train_only=False):
     else:
     	print("Not using CUDA")
 
-    buffer_gpus = 0.1 if use_cuda else 0
-    
     ray.init()
     
     memory = Memory.options(num_cpus=0.1).remote(config, log_dir)
-    buffer = Buffer.options(num_cpus=0.1, num_gpus=buffer_gpus).remote(config, memory)
+    # The games are split between buffer_shards buffers, each building its part of the batches the trainer
+    # prefetches concurrently, besides handling other calls
+    buffer_shards = [
+        Buffer.options(num_cpus=0.1, max_concurrency=config["prefetch_batches"] + 2).remote(
+            config, memory, shard=shard
+        )
+        for shard in range(config["buffer_shards"])
+    ]
+    buffer = ShardedBuffer(buffer_shards)
 
     # open muz implementation uses a GameHistory class
     # with observation_history, action_history, reward_history
@@ -130,13 +137,33 @@ def run(config, train_only=False):
 
     train_cpus = 0 if use_cuda else 0.1
     train_gpus = 0.9 if use_cuda else 0
+
+    # The searches of the player and reanalyser can share a model held by a single InferenceServer,
+    # which batches their requests together, rather than each running their own copy
+    if config["inference_server"]:
+        inference_gpus = 0.3 if use_cuda else 0
+        train_gpus -= inference_gpus
+        inference_server = InferenceServer.options(num_cpus=0.3, num_gpus=inference_gpus).remote(
+            config=config,
+            mu_net=muzero_network,
+            log_dir=log_dir,
+            memory=memory,
+            device=device,
+        )
+        search_network = InferenceClient(inference_server, muzero_network)
+    else:
+        search_network = muzero_network
+
     trainer = Trainer.options(num_cpus=train_cpus, num_gpus=train_gpus).remote()
 
+    # Memory pushes the run counters to these actors whenever they change, rather than them asking for them
+    ray.get([memory.subscribe.remote(actor) for actor in (*buffer_shards, player, trainer)])
+
     if not train_only:
         workers.append(
             player.play.remote(
                 config=config,
-                mu_net=muzero_network,
+                mu_net=search_network,
                 log_dir=log_dir,
                 device=torch.device("cpu"),
                 memory=memory,
@@ -157,15 +184,17 @@ def run(config, train_only=False):
     )
 
     if config["reanalyse"]:
-        print("adding reanalyser")
-        analyser = Reanalyser.options(num_cpus=0.1).remote(
-            config=config, log_dir=log_dir
-        )
-        workers.append(
-            analyser.reanalyse.remote(
-                mu_net=muzero_network, memory=memory, buffer=buffer
+        print(f"adding {config['reanalyse_n']} reanalyser(s)")
+        for _ in range(config["reanalyse_n"]):
+            analyser = Reanalyser.options(num_cpus=0.1).remote(
+                config=config, log_dir=log_dir
+            )
+            ray.get(memory.subscribe.remote(analyser))
+            workers.append(
+                analyser.reanalyse.remote(
+                    mu_net=search_network, memory=memory, buffer=buffer
+                )
             )
-        )
 
     ray.get(workers)
 
@@ -1,4 +1,6 @@
 # import datetime
+import copy
+import functools
 import math
 import os
 import random
@@ -8,19 +10,14 @@ import yaml
 import pickle
 import numpy as np
 import ray
-from itertools import product
+from collections import deque
 from matplotlib import pyplot as plt
 
-from operator import mul
-from functools import reduce
-
 import torch
 from torch import nn
 
 from torch.utils.tensorboard import SummaryWriter
 
-from models import scalar_to_support, support_to_scalar
-
 
 def search(
     config,
@@ -28,164 +25,356 @@ def search(
     current_frame,
     minmax,
     device=torch.device("cpu"),
+    tree=None,
+    tracer=None,
 ):
     """
     This function takes a frame and creates a tree of possible actions that could
     be taken from the frame, assessing the expected value at each location
     and returning this tree which contains the data needed to choose an action
 
-    The models expect inputs where the first dimension is a batch dimension,
-    but the way in which we traverse the tree means we only pass a single
-    input at a time. There is therefore the need to consistently squeeze and unsqueeze
-    (ie add and remove the first dimension) so as not to confuse things by carrying around
-    extraneous dimensions
+    It is a thin wrapper around search_batch with a single frame, so that a
+    lone game and many games in lockstep go through exactly the same code
+
+    If tree is given (a subtree kept from the previous move, see SearchTree.subtree)
+    the search carries on from it rather than starting from current_frame
 
     Note that mu_net returns logits for the policy, value and reward
     and that the value and reward are represented categorically rather than
     as a scalar
     """
+    return search_batch(
+        config, mu_net, [current_frame], minmax, device=device, trees=[tree], tracer=tracer
+    )[0]
+
+
+def search_batch(
+    config,
+    mu_net,
+    frames,
+    minmax,
+    device=torch.device("cpu"),
+    trees=None,
+    tracer=None,
+):
+    """
+    Builds one search tree per frame in frames, advancing all of the trees in lockstep.
+
+    At every simulation each tree is traversed until it reaches an unexplored action,
+    and the leaves of all trees are then expanded together with a single batched call
+    to the dynamics and prediction functions, rather than one forward pass of batch size 1
+    per tree. Returns the list of search trees, in the same order as frames.
+
+    The trees share minmax, in the same way that consecutive calls to search would.
+
+    trees can hold, for each frame, a tree returned by SearchTree.subtree to carry on searching from,
+    or None to start a new tree from the frame. A reused tree keeps its nodes and only runs the
+    simulations left from the n_simulations budget, with fresh Dirichlet noise at its root.
+
+    tracer is a SearchTracer recording every simulation, by default the no-op NullTracer.
+
+    With gumbel_root, the root uses Gumbel noise and sequential halving instead of Dirichlet noise and PUCT,
+    as in Gumbel MuZero, see SearchTree.gumbel_root_action.
+
+    With adaptive_search, n_simulations is only the maximum: after min_simulations a tree stops
+    as soon as the action with the most visits can't be overtaken with the simulations left,
+    or once its share of the visits of the root has stayed within adaptive_share_tol for adaptive_patience
+    consecutive checks. The simulations run by each search are stored in SearchTree.simulations_run.
+    """
 
     print_timing("Init search", config)
 
     mu_net.eval()
     mu_net = mu_net.to(device)
 
-    with torch.no_grad():
-        #print("Current frame:" + str(current_frame))
-        if config["obs_type"] in {"cartpole","bipedalwalker"} and len(current_frame) == 2:
-            frame_t = torch.tensor(current_frame[0], device=device)
-        else:
-        	frame_t = torch.tensor(current_frame, device=device)
-        #print("Frame_t:" + str(frame_t))
-        init_latent = mu_net.represent(frame_t.unsqueeze(0))[0]
-        init_policy, init_val = [x[0] for x in mu_net.predict(init_latent.unsqueeze(0))]
-
-        # Getting probabilities from logits and a scalar value from the categorical support
-        init_policy_probs = torch.softmax(init_policy, -1)
-        if not config["nec"]:
-            init_val = support_to_scalar(torch.softmax(init_val, 0))
-
-        init_policy_probs = add_dirichlet(
-            init_policy_probs,
-            config["root_dirichlet_alpha"],
-            config["explore_frac"],
-        )
+    if trees is None:
+        trees = [None] * len(frames)
+    trees = list(trees)
+    if tracer is None:
+        tracer = NullTracer()
 
-        if config["value_prefix"]:
-            # Hidden size must be (num_layers, batch_size, hidden_size)
-            init_lstm_hiddens = (
-                torch.zeros(1, 1, config["lstm_hidden_size"]).detach(),
-                torch.zeros(1, 1, config["lstm_hidden_size"]).detach(),
+    with torch.no_grad():
+        # initialize a new search tree with a root node for each frame that doesn't have one
+        new_ndxs = [i for i, tree in enumerate(trees) if tree is None]
+        if new_ndxs:
+            frames_t = torch.stack(
+                [frame_to_tensor(config, frames[i], device) for i in new_ndxs]
             )
-        else:
-            init_lstm_hiddens = None
-
-
-        # initialize the search tree with a root node
-        if config["obs_type"] == "bipedalwalker":
-            # Contains the available values for each component of the action
-            dim_action_values = config["dim_action_values"]
-            possible_actions = mu_net.possible_actions
-            possible_action_indices = mu_net.possible_action_indices
-        else:
-            action_dim = 1
-            possible_actions = range(mu_net.action_size)
-            possible_action_indices = None
-
-        root_node = TreeNode(
-            latent=init_latent,
-            mu_net=mu_net,
-            val_pred=init_val,
-            pol_pred=init_policy_probs,
-            minmax=minmax,
-            num_visits=0,
-            lstm_hiddens=init_lstm_hiddens,
-        )
+            init_latents, init_policy_probs, init_vals = mu_net.initial_inference(frames_t)
+
+            init_vals = init_vals.reshape(-1).cpu().numpy()
+            init_priors, init_actions = expansion_priors(config, mu_net, init_policy_probs)
+
+            for j, i in enumerate(new_ndxs):
+                trees[i] = SearchTree(
+                    mu_net=mu_net,
+                    minmax=minmax,
+                    capacity=config["n_simulations"] + 1,
+                    latent_shape=init_latents.shape[1:],
+                    device=device,
+                )
+                trees[i].add_root(
+                    latent=init_latents[j],
+                    val_pred=init_vals[j],
+                    prior=init_priors[j],
+                    actions=init_actions[j] if init_actions is not None else None,
+                )
+
+        for tree in trees:
+            if config["gumbel_root"]:
+                tree.add_gumbel_noise()
+            else:
+                tree.add_exploration_noise(
+                    config["root_dirichlet_alpha"],
+                    config["explore_frac"],
+                )
 
         print_timing("Start search simulations", config)
 
-        for i in range(config["n_simulations"]):
-            with open("debug.log", 'a') as logfile:
-                print(f"i:", i, file=logfile)
-            # vital to have with(torch.no_grad() or the size of the computation graph quickly becomes gigantic
-            current_node = root_node
-            new_node = False
-
-            # search list tracks the route of the simulation through the tree
-            search_list = []
-            while not new_node:
-                search_list.append(current_node)
-                value_pred = current_node.val_pred
-                policy_pred = current_node.pol_pred
-                latent = current_node.latent
-                action = current_node.pick_action()
-                lstm_hiddens = current_node.lstm_hiddens
-
-                # if we pick an action that's been picked before we don't need to run the model to explore it
-                if current_node.children[action] is None:
-                    if config["obs_type"] == "bipedalwalker":
-                        action_t = torch.tensor([eval(action)], device=device)
+        # With leaf_batch_size > 1, several leaves are selected from each tree before running the model,
+        # using virtual loss so that the simulations of a batch spread over different branches
+        leaf_batch_size = config["leaf_batch_size"]
+        # Every simulation adds one node, so a reused tree has already done n_nodes - 1 of them
+        n_simulations = [tree.n_nodes - 1 for tree in trees]
+        start_simulations = list(n_simulations)
+        # For each tree, whether it stopped early, and the leading action and its share
+        # at the last check together with the number of checks this share has been stable for
+        stopped = [False] * len(trees)
+        leader_stats = [(None, 0.0, 0)] * len(trees)
+
+        def active_trees():
+            return [
+                tree_ndx
+                for tree_ndx in range(len(trees))
+                if n_simulations[tree_ndx] < config["n_simulations"] and not stopped[tree_ndx]
+            ]
+
+        while active_trees():
+            # each leaf holds the tree, the route of the simulation through it,
+            # and the actions taken from each node of that route, the last of which is to be expanded
+            leaves = []
+            for tree_ndx in active_trees():
+                tree = trees[tree_ndx]
+                n_leaves = min(leaf_batch_size, config["n_simulations"] - n_simulations[tree_ndx])
+                tree_leaves = []
+                for _ in range(n_leaves):
+                    search_list, search_actions = tree.select_leaf(
+                        virtual_loss=leaf_batch_size > 1
+                    )
+                    # If another simulation of this batch is already expanding the same action
+                    # we drop this one, rather than running the model twice for the same node
+                    if tree.virtual_losses[search_list[-1], search_actions[-1]] > 1:
+                        tree.revert_virtual_loss(search_list, search_actions)
                     else:
-                        # Convert to a 2D tensor one-hot encoding the action
-                        action_t = nn.functional.one_hot(
-                            torch.tensor([action], device=device),
-                            num_classes=mu_net.action_size,
-                        )
+                        tree_leaves.append((tree, search_list, search_actions))
+
+                for _, search_list, search_actions in tree_leaves:
+                    if leaf_batch_size > 1:
+                        tree.revert_virtual_loss(search_list, search_actions)
+                n_simulations[tree_ndx] += len(tree_leaves)
+                leaves += tree_leaves
+
+            # The children of a node are indexed by slot, which is the action itself unless sampling actions
+            leaf_actions = [
+                tree.slot_action(nodes[-1], slots[-1]) for tree, nodes, slots in leaves
+            ]
+            if config["obs_type"] == "bipedalwalker":
+                actions_t = torch.tensor(mu_net.decode_actions(leaf_actions), device=device)
+            else:
+                # Convert to a 2D tensor one-hot encoding the actions
+                actions_t = nn.functional.one_hot(
+                    torch.tensor(leaf_actions, device=device),
+                    num_classes=mu_net.action_size,
+                )
+
+            latents = torch.stack([tree.latents[nodes[-1]] for tree, nodes, _ in leaves])
+            if config["value_prefix"]:
+                # Hidden size must be (num_layers, batch_size, hidden_size)
+                lstm_hiddens = torch.stack(
+                    [tree.lstm_hiddens[:, nodes[-1]] for tree, nodes, _ in leaves],
+                    dim=1,
+                ).unsqueeze(1)
+                lstm_hiddens = (lstm_hiddens[0], lstm_hiddens[1])
+            else:
+                lstm_hiddens = None
+
+            # apply the dynamics function to get a representation of the state after each action,
+            # and the reward gained, then estimate the policy and value at these new states
+            print_timing("Start running model (search)", config)
+            if tracer.enabled:
+                model_start = time.perf_counter()
+            (
+                new_latents,
+                rewards,
+                new_vals,
+                policy_probs,
+                new_hiddens,
+            ) = mu_net.recurrent_inference(latents, actions_t, lstm_hiddens)
+            print_timing("Finish running model (search)", config)
+            if tracer.enabled:
+                model_time = time.perf_counter() - model_start
+                for (tree, search_list, _), action in zip(leaves, leaf_actions):
+                    tracer.record(len(search_list), action, model_time, len(leaves))
+
+            rewards = rewards.cpu().numpy()
+            new_vals = new_vals.reshape(-1).cpu().numpy()
+            priors, child_actions = expansion_priors(config, mu_net, policy_probs)
+
+            for j, (tree, search_list, search_actions) in enumerate(leaves):
+                tree.insert(
+                    search_list[-1],
+                    search_actions[-1],
+                    latent=new_latents[j],
+                    val_pred=new_vals[j],
+                    prior=priors[j],
+                    actions=child_actions[j] if child_actions is not None else None,
+                    reward=rewards[j],
+                    lstm_hiddens=(
+                        (new_hiddens[0][0, j], new_hiddens[1][0, j])
+                        if new_hiddens is not None
+                        else None
+                    ),
+                )
+
+                # Updates the visit counts and average values of the nodes that have been traversed
+                tree.backpropagate(search_list, new_vals[j], config["discount"])
+
+            if config["adaptive_search"]:
+                for tree_ndx in active_trees():
+                    if n_simulations[tree_ndx] < config["min_simulations"]:
+                        continue
+                    stopped[tree_ndx], leader_stats[tree_ndx] = check_early_stop(
+                        config,
+                        trees[tree_ndx],
+                        config["n_simulations"] - n_simulations[tree_ndx],
+                        *leader_stats[tree_ndx],
+                    )
 
-                    # apply the dynamics function to get a representation of the state after the action,
-                    # and the reward gained
-                    # then estimate the policy and value at this new state
+    for tree, n_sims, n_start in zip(trees, n_simulations, start_simulations):
+        tree.simulations_run = n_sims - n_start
+    return trees
 
-                    print_timing("Start running model (search)", config)
 
-                    if config["value_prefix"]:
-                        latent, reward, new_hiddens = mu_net.dynamics(
-                            latent.unsqueeze(0), action_t, lstm_hiddens
-                        )
-                        latent = latent.squeeze_(0)
-                        reward = reward.squeeze_(0)
+def check_early_stop(config, tree, n_left, last_leader, last_share, n_stable):
+    """
+    Decides whether the search of tree can stop with n_left simulations still in the budget,
+    given the leading action and its share of the root visits at the last check, and the number
+    of consecutive checks for which this share has been stable.
+    Returns the decision, and the leader, share and count of stable checks to pass to the next check
+    """
+    visits = tree.child_visits()
+    leader = int(np.argmax(visits))
+    share = visits[leader] / max(visits.sum(), 1)
+    if leader == last_leader and abs(share - last_share) < config["adaptive_share_tol"]:
+        n_stable += 1
+    else:
+        n_stable = 0
 
-                    else:
-                        latent, reward = [
-                            x[0] for x in mu_net.dynamics(latent.unsqueeze(0), action_t)
-                        ]
-                        new_hiddens = None
-
-                    new_policy, new_val = [
-                        x[0] for x in mu_net.predict(latent.unsqueeze(0))
-                    ]
-
-                    # print(new_policy)
-
-                    print_timing("Finish running model (search)", config)
-
-                    # convert logits to scalars and probaility distributions
-                    reward = support_to_scalar(torch.softmax(reward, 0))
-                    # Current NEC implementation does not use supported codomain
-                    if not config["nec"]:
-                        new_val = support_to_scalar(torch.softmax(new_val, 0))
-
-                    policy_probs = torch.softmax(new_policy, 0)
-                    current_node.insert(
-                        action_n=action,
-                        latent=latent,
-                        val_pred=new_val,
-                        pol_pred=policy_probs,
-                        reward=reward,
-                        minmax=minmax,
-                        config=config,
-                        lstm_hiddens=new_hiddens,
-                    )
+    # Even if every simulation left went to the runner up it couldn't catch up with the leader
+    runner_up = np.partition(visits, -2)[-2] if len(visits) > 1 else 0
+    unbeatable = visits[leader] - runner_up > n_left
+    return unbeatable or n_stable >= config["adaptive_patience"], (leader, share, n_stable)
 
-                    # We have reached a new node and therefore this is the end of the simulation
-                    new_node = True
-                else:
-                    # If we have already explored this node then we take the child as our new current node
-                    current_node = current_node.children[action]
 
-            # Updates the visit counts and average values of the nodes that have been traversed
-            backpropagate(search_list, new_val, minmax, config["discount"])
-    return root_node
+def frame_to_tensor(config, frame, device=torch.device("cpu")):
+    # Gym's reset returns an (observation, info) pair for the vector environments
+    if config["obs_type"] in {"cartpole", "bipedalwalker"} and len(frame) == 2:
+        return torch.tensor(frame[0], device=device)
+    return torch.tensor(frame, device=device)
+
+
+def joint_policy(policy_probs):
+    """
+    Turns a batch of policies with several action dimensions, of shape (batch, action_dim, action_size),
+    into the prior of every joint action, of shape (batch, action_size ** action_dim), in the same order
+    as the action tables of the model (the first dimension being the most significant)
+    """
+    prior = policy_probs[:, 0]
+    for i in range(1, policy_probs.shape[1]):
+        # Outer product with the policy of the next dimension
+        prior = (prior.unsqueeze(2) * policy_probs[:, i].unsqueeze(1)).flatten(1)
+    return prior
+
+
+def sample_actions(policy_probs, n_samples):
+    """
+    Samples n_samples joint actions from each of a batch of policies of shape (batch, action_dim, action_size),
+    drawing the value of each dimension independently, as in Sampled MuZero.
+    Returns the empirical frequency of each distinct joint action sampled and the action itself,
+    as arrays of shape (batch, n_samples) sorted by decreasing frequency, padded with a frequency of 0
+    and an action of -1 when fewer than n_samples distinct actions were sampled
+    """
+    batch_size, action_dim, action_size = policy_probs.shape
+    samples = torch.multinomial(
+        policy_probs.reshape(-1, action_size), n_samples, replacement=True
+    )
+    samples = samples.reshape(batch_size, action_dim, n_samples).cpu().numpy()
+    # The values taken in each dimension are the digits of the joint action in base action_size
+    place_values = action_size ** np.arange(action_dim - 1, -1, -1)
+    joint_samples = np.einsum("bds,d->bs", samples, place_values)
+
+    freqs = np.zeros((batch_size, n_samples))
+    actions = np.full((batch_size, n_samples), -1, dtype=np.int64)
+    for i in range(batch_size):
+        sampled, counts = np.unique(joint_samples[i], return_counts=True)
+        order = np.argsort(-counts, kind="stable")
+        freqs[i, : len(sampled)] = counts[order] / n_samples
+        actions[i, : len(sampled)] = sampled[order]
+    return freqs, actions
+
+
+def expansion_priors(config, mu_net, policy_probs):
+    """
+    Turns a batch of policies from the prediction function into the priors of the children of new nodes.
+    Returns these as a numpy array, together with the action of each child when sampling actions,
+    or None when the children are all of the actions in order
+    """
+    if config["sampled_actions"]:
+        if policy_probs.dim() == 2:
+            policy_probs = policy_probs.unsqueeze(1)
+        return sample_actions(policy_probs, config["sampled_actions"])
+    if mu_net.action_dim > 1:
+        policy_probs = joint_policy(policy_probs)
+    return policy_probs.cpu().numpy(), None
+
+
+@functools.lru_cache(maxsize=None)
+def considered_visits(max_considered, n_simulations):
+    """
+    Sequential halving schedule of Gumbel MuZero: for each simulation, the visit count that the
+    actions considered at the root must have to be picked. The max_considered actions are visited
+    in turn, and the number considered is halved after every round of visits, keeping the best,
+    with the rounds sized so that the simulations are shared evenly between the log2(max_considered) phases
+    """
+    if max_considered <= 1:
+        return tuple(range(n_simulations))
+    log2max = math.ceil(math.log2(max_considered))
+    sequence = []
+    visits = [0] * max_considered
+    n_considered = max_considered
+    while len(sequence) < n_simulations:
+        n_extra_visits = max(1, int(n_simulations / (log2max * n_considered)))
+        for _ in range(n_extra_visits):
+            sequence.extend(visits[:n_considered])
+            for i in range(n_considered):
+                visits[i] += 1
+        n_considered = max(2, n_considered // 2)
+    return tuple(sequence[:n_simulations])
+
+
+def joint_marginals(joint, action_size, action_dim):
+    """
+    Sums an array over the joint actions, such as a prior or visit counts, into
+    an array of shape (action_dim, action_size) with the total for each value of each dimension
+    """
+    joint = np.asarray(joint).reshape((action_size,) * action_dim)
+    return np.stack(
+        [
+            joint.sum(axis=tuple(d for d in range(action_dim) if d != i))
+            for i in range(action_dim)
+        ]
+    )
+
 
 def print_timing(tag, config, min_time=0.05):
     if config["train_speed_profiling"]:
@@ -197,149 +386,417 @@ def print_timing(tag, config, min_time=0.05):
 print_timing.last_time = None
 
 
-def backpropagate(search_list, value, minmax, discount):
-    """Going backward through the visited nodes, we increase the visit count of each by one
-    and set the value, discounting the value at the node ahead, but then adding the reward"""
-    inversed_search_list = search_list[::-1]
-    for i, node in enumerate(inversed_search_list):
-        node.num_visits += 1
-        if (not node.config["value_prefix"]) or i==(len(inversed_search_list)-1):
-            reward = node.reward
-        # When using value prefix, node.reward stores the value prefix
-        # In that case we compute the reward by substracting the next
-        # value prefix from the current value prefix
-        else:
-            reward = inversed_search_list[i].reward - inversed_search_list[i+1].reward
-            # reward = node.reward
-
-        reward = node.reward
+class SearchTree:
+    """
+    SearchTree holds a whole search tree as a set of preallocated arrays indexed by node id,
+    rather than as one Python object per node. The root is always node 0.
 
-        value = reward + (value * discount)
-        node.update_val(value)
-        minmax.update(value)
+    children[node, action] is the id of the node reached by taking action from node, or -1 if
+    that action hasn't been explored yet.
 
+    With sampled_actions set, each node only considers that many joint actions, sampled from its policy,
+    and its children are indexed by slot rather than by action: slot_actions[node, slot] holds the
+    action of each slot, or -1 for unused slots, and the slots are sorted by decreasing prior.
+    With widening_factor set, only the first widening_factor * N ** widening_exponent slots of a node
+    with N visits can be picked, so that less likely actions are only considered as visits grow.
 
-class TreeNode:
-    """
-    TreeNode is an individual node of a search tree.
-    It has one potential child for each potential action which, if it exists, is another TreeNode
-    Its function is to hold the relevant statistics for deciding which action to take.
+    The latents, and the LSTM hiddens when using value prefix, are stored as rows of single preallocated
+    tensors, so that a batch of them can be gathered by indexing. Nodes are only added when they are chosen,
+    rather than when their parent is chosen, so a search with n simulations needs a capacity of n + 1 nodes.
     """
 
     def __init__(
         self,
-        latent,
         mu_net,
-        val_pred=None,
-        pol_pred=None,
-        parent=None,
-        reward=0,
-        minmax=None,
-        num_visits=1,
-        lstm_hiddens=None,
+        minmax,
+        capacity,
+        latent_shape,
+        device=torch.device("cpu"),
     ):
+        self.config = mu_net.config
+        self.minmax = minmax
+        self.capacity = capacity
+        self.n_nodes = 0
 
-        self.mu_net = mu_net
         self.action_size = mu_net.action_size
         self.action_dim = mu_net.action_dim
-        self.possible_actions = mu_net.possible_actions
-
-        if self.action_dim > 1:
-            self.possible_actions_str = mu_net.possible_actions_str
-            self.possible_action_indices = mu_net.possible_action_indices
-
-            # When we have multiple action dimensions, we represent each child
-            # with a list (converted to string) of the index for each action in
-            # each dimension. 
-            # For example: '[1, 3, 3, 1]' (action 1 in the first and fourth dims and 
-            # action 3 in the second and third)
-            self.children = {action_str : None 
-                             for action_str in self.possible_actions_str
-                            }
-            # self.pol_pred = {action_str : [pol_pred[i][action_idx] for i, action_idx in enumerate(action_indices)]
-            #                  for action_str, action_indices in zip(self.possible_actions_str, self.possible_action_indices)
-            #                 } 
-
-            self.pol_pred = pol_pred
+
+        # Actions are encoded as integers, which index the children of each node. When we have multiple
+        # action dimensions these are joint actions, decoded with decode_actions of the model
+        self.n_actions = self.action_size ** self.action_dim
+        self.n_sampled = self.config["sampled_actions"]
+        self.n_slots = self.n_sampled if self.n_sampled else self.n_actions
+
+        self.children = np.full((capacity, self.n_slots), -1, dtype=np.int32)
+        self.parents = np.full(capacity, -1, dtype=np.int32)
+        self.visit_counts = np.zeros(capacity, dtype=np.int32)
+        self.average_vals = np.zeros(capacity)
+        self.val_preds = np.zeros(capacity)
+        self.rewards = np.zeros(capacity)
+        self.priors = np.zeros((capacity, self.n_slots))
+        # Simulations currently in flight through each action of each node, see select_leaf
+        self.virtual_losses = np.zeros((capacity, self.n_slots), dtype=np.int32)
+        if self.n_sampled:
+            self.slot_actions = np.full((capacity, self.n_slots), -1, dtype=np.int64)
+        else:
+            self.slot_actions = None
+
+        self.latents = torch.zeros((capacity, *latent_shape), device=device)
+        if self.config["value_prefix"]:
+            # The (h, c) pair of every node, so the hiddens of a batch of nodes are lstm_hiddens[:, nodes]
+            self.lstm_hiddens = torch.zeros(
+                2, capacity, self.config["lstm_hidden_size"], device=device
+            )
         else:
-            self.children = [None] * self.action_size
-            self.pol_pred = pol_pred
+            self.lstm_hiddens = None
 
-        self.latent = latent
-        self.val_pred = val_pred
-        self.parent = parent
-        self.average_val = val_pred
-        self.num_visits = num_visits
-        self.reward = reward
+    @property
+    def val_pred(self):
+        return self.val_preds[0]
 
-        self.minmax = minmax
-        self.config = mu_net.config
-        self.lstm_hiddens = lstm_hiddens
+    @property
+    def average_val(self):
+        return self.average_vals[0]
+
+    @property
+    def pol_pred(self):
+        return self.priors[0]
+
+    def add_node(
+        self,
+        latent,
+        val_pred,
+        prior,
+        reward=0,
+        num_visits=1,
+        lstm_hiddens=None,
+        actions=None,
+    ):
+        if self.n_nodes >= self.capacity:
+            raise ValueError("The search tree is full")
+
+        node = self.n_nodes
+        self.n_nodes += 1
+
+        self.latents[node] = latent
+        self.val_preds[node] = val_pred
+        self.average_vals[node] = val_pred
+        self.priors[node] = prior
+        if actions is not None:
+            self.slot_actions[node] = actions
+        self.rewards[node] = reward
+        self.visit_counts[node] = num_visits
+        if lstm_hiddens is not None:
+            self.lstm_hiddens[0, node] = lstm_hiddens[0]
+            self.lstm_hiddens[1, node] = lstm_hiddens[1]
+        return node
+
+    def add_root(self, latent, val_pred, prior, actions=None):
+        # The root starts without visits, and its LSTM hiddens are left at zero
+        return self.add_node(latent, val_pred, prior, num_visits=0, actions=actions)
+
+    def add_gumbel_noise(self):
+        """Samples the Gumbel noise of each action of the root, used by gumbel_root_action"""
+        self.root_gumbel = np.random.gumbel(size=self.n_slots)
+
+    def add_exploration_noise(self, dirichlet_alpha, explore_frac, node=0):
+        """Mixes Dirichlet noise into the prior of node (the root by default)"""
+        if self.n_sampled:
+            # Only the actions which were sampled are noised
+            sampled = self.slot_actions[node] != -1
+            noisy_policy = add_dirichlet(
+                torch.tensor(self.priors[node, sampled]), dirichlet_alpha, explore_frac
+            )
+            self.priors[node, sampled] = noisy_policy.numpy()
+        elif self.action_dim > 1:
+            # The joint prior is a product of the policies of each dimension,
+            # so these are recovered as its marginals and noised separately
+            policy = joint_marginals(self.priors[node], self.action_size, self.action_dim)
+            noisy_policy = add_dirichlet(torch.tensor(policy), dirichlet_alpha, explore_frac)
+            self.priors[node] = joint_policy(noisy_policy.unsqueeze(0))[0].numpy()
+        else:
+            noisy_policy = add_dirichlet(
+                torch.tensor(self.priors[node]), dirichlet_alpha, explore_frac
+            )
+            self.priors[node] = noisy_policy.numpy()
 
     def insert(
         self,
+        node,
         action_n,
         latent,
         val_pred,
-        pol_pred,
+        prior,
         reward,
-        minmax,
-        config,
         lstm_hiddens=None,
+        actions=None,
     ):
-        # The implementation here differs from the open MuZero (werner duvaud)
-        # by only initializing tree nodes when they are chosen, rather than when their parent is chosen
-        if self.children[action_n] is None:
-            new_child = TreeNode(
-                latent=latent,
-                val_pred=val_pred,
-                pol_pred=pol_pred,
-                mu_net=self.mu_net,
-                parent=self,
-                reward=reward,
-                minmax=minmax,
-                lstm_hiddens=lstm_hiddens,
-            )
+        if self.children[node, action_n] != -1:
+            raise ValueError("This node has already been traversed")
 
-            self.children[action_n] = new_child
+        child = self.add_node(
+            latent=latent,
+            val_pred=val_pred,
+            prior=prior,
+            reward=reward,
+            lstm_hiddens=lstm_hiddens,
+            actions=actions,
+        )
+        self.parents[child] = node
+        self.children[node, action_n] = child
+        return child
 
-        else:
-            raise ValueError("This node has already been traversed")
+    def select_leaf(self, virtual_loss=False):
+        """
+        Goes down the tree from the root until it picks an action that hasn't been explored,
+        returning the list of nodes traversed and the action taken from each of them,
+        the last of which is the action to expand.
 
-    def update_val(self, curr_val):
+        With virtual_loss, each action taken counts as a visit with the lowest value until
+        revert_virtual_loss is called, steering later selections towards other branches.
+        """
+        node = 0
+        search_list = []
+        search_actions = []
+        while True:
+            search_list.append(node)
+            action = self.pick_action(node)
+            search_actions.append(action)
+            if virtual_loss:
+                self.virtual_losses[node, action] += 1
+
+            # if we pick an action that's been picked before we don't need to run the model to explore it
+            if self.children[node, action] == -1:
+                return search_list, search_actions
+
+            # If we have already explored this node then we take the child as our new current node
+            node = self.children[node, action]
+
+    def revert_virtual_loss(self, search_list, search_actions):
+        self.virtual_losses[search_list, search_actions] -= 1
+
+    def backpropagate(self, search_list, value, discount):
+        """Going backward through the visited nodes, we increase the visit count of each by one
+        and set the value, discounting the value at the node ahead, but then adding the reward"""
+        for node in reversed(search_list):
+            self.visit_counts[node] += 1
+            # When using value prefix, the reward of each node holds its value prefix, which is used as is
+            value = self.rewards[node] + (value * discount)
+            self.update_val(node, value)
+            self.minmax.update(value)
+
+    def update_val(self, node, curr_val):
         """Updates the average value of a node when a new value is receivied
         copies the formula of the muzero paper rather than the neater form of
         just tracking the sum and dividng as needed
         """
-        nmtr = self.average_val * self.num_visits + curr_val
-        dnmtr = self.num_visits + 1
-        self.average_val = nmtr / dnmtr
+        nmtr = self.average_vals[node] * self.visit_counts[node] + curr_val
+        dnmtr = self.visit_counts[node] + 1
+        self.average_vals[node] = nmtr / dnmtr
+
+    def slot_action(self, node, slot):
+        """Action of the child of node in slot"""
+        if self.n_sampled:
+            return int(self.slot_actions[node, slot])
+        return int(slot)
+
+    def action_slot(self, action, node=0):
+        """Slot of the child of node reached by action, or None if action wasn't sampled at node"""
+        if self.n_sampled:
+            slots = np.flatnonzero(self.slot_actions[node] == action)
+            return slots[0] if len(slots) > 0 else None
+        return action
+
+    def subtree(self, action):
+        """
+        Returns a new tree holding the subtree below the child reached by action from the root,
+        with that child as its root, or None if action was never explored. The nodes keep their
+        latents, LSTM hiddens and statistics, so the next search can carry on from them.
+        """
+        slot = self.action_slot(action)
+        child = self.children[0, slot] if slot is not None else -1
+        if child == -1:
+            return None
+
+        # Gather the subtree breadth first, so that the new root is node 0 and parents come before children
+        nodes = [np.array([child])]
+        while len(nodes[-1]) > 0:
+            grandchildren = self.children[nodes[-1]]
+            nodes.append(grandchildren[grandchildren != -1])
+        nodes = np.concatenate(nodes)
+        n_kept = len(nodes)
+
+        new_ids = np.full(self.capacity, -1, dtype=np.int32)
+        new_ids[nodes] = np.arange(n_kept)
+
+        def take(array, fill=0):
+            new_array = np.full_like(array, fill)
+            new_array[:n_kept] = array[nodes]
+            return new_array
+
+        tree = copy.copy(self)
+        tree.n_nodes = n_kept
+        children = self.children[nodes]
+        tree.children = np.full_like(self.children, -1)
+        tree.children[:n_kept] = np.where(children != -1, new_ids[children], -1)
+        tree.parents = take(new_ids[self.parents], -1)
+        tree.visit_counts = take(self.visit_counts)
+        tree.average_vals = take(self.average_vals)
+        tree.val_preds = take(self.val_preds)
+        tree.rewards = take(self.rewards)
+        tree.priors = take(self.priors)
+        if self.slot_actions is not None:
+            tree.slot_actions = take(self.slot_actions, -1)
+        tree.virtual_losses = np.zeros_like(self.virtual_losses)
+
+        nodes_t = torch.tensor(nodes, device=self.latents.device)
+        tree.latents = torch.zeros_like(self.latents)
+        tree.latents[:n_kept] = self.latents[nodes_t]
+        if self.lstm_hiddens is not None:
+            tree.lstm_hiddens = torch.zeros_like(self.lstm_hiddens)
+            tree.lstm_hiddens[:, :n_kept] = self.lstm_hiddens[:, nodes_t]
+
+        # Children start with a visit, while the root starts with none,
+        # so the new root only counts the simulations that went through it
+        n_backups = self.visit_counts[child] - 1
+        tree.visit_counts[0] = n_backups
+        # The reward of the action that led to the new root is behind us, so it is taken out of its value,
+        # so that it matches the value of a fresh root given the same backups. As update_val counts
+        # the value prediction of a child twice but that of a root once, the average is rebuilt from the sum
+        # of the backed up values
+        tree.rewards[0] = 0
+        val_pred = self.val_preds[child]
+        backed_up = (
+            self.average_vals[child] * (self.visit_counts[child] + 1)
+            - 2 * val_pred
+            - n_backups * self.rewards[child]
+        )
+        tree.average_vals[0] = (val_pred + backed_up) / (n_backups + 1)
+        return tree
+
+    def child_visits(self, node=0):
+        """Visit counts of the children of node, with 0 for the actions that haven't been explored"""
+        children = self.children[node]
+        return np.where(children != -1, self.visit_counts[children], 0)
+
+    def dimension_totals(self, values, node=0):
+        """
+        Sums values, which hold one value per child of node, over the value taken in each action dimension,
+        returning an array of shape (action_dim, action_size)
+        """
+        if self.n_sampled:
+            actions = self.slot_actions[node]
+            values = values[actions != -1]
+            actions = actions[actions != -1]
+        else:
+            actions = np.arange(self.n_actions)
+
+        dim_values = np.unravel_index(actions, (self.action_size,) * self.action_dim)
+        totals = np.zeros((self.action_dim, self.action_size), dtype=values.dtype)
+        for i, dim_value in enumerate(dim_values):
+            np.add.at(totals[i], dim_value, values)
+        return totals
+
+    def dimension_visits(self, node=0):
+        """Visit counts of the children of node summed over the value taken in each action dimension"""
+        return self.dimension_totals(self.child_visits(node), node)
+
+    def search_policy(self):
+        """
+        Policy target given by the search for each action dimension, as an array of shape (action_dim, action_size):
+        the visit counts of the children of the root, or the improved policy when using gumbel_root
+        """
+        if self.config["gumbel_root"]:
+            return self.dimension_totals(self.improved_policy())
+        return self.dimension_visits()
+
+    def completed_q(self, node=0):
+        """
+        Normalized values of the children of node as used by Gumbel MuZero, where the unvisited
+        children take a mix of the value predicted at node and the values of the visited children
+        """
+        visits = self.child_visits(node)
+        visited = visits > 0
+        children = self.children[node]
+        q = np.where(visited, self.average_vals[children], 0)
+
+        priors = self.priors[node]
+        visited_prior = priors[visited].sum()
+        if visited_prior > 0:
+            weighted_q = (priors * q)[visited].sum() / visited_prior
+        else:
+            weighted_q = 0
+        mixed_val = (self.val_preds[node] + visits.sum() * weighted_q) / (visits.sum() + 1)
+        return self.minmax.normalize(np.where(visited, q, mixed_val))
+
+    def gumbel_scores(self, node=0):
+        """
+        The log prior plus the transformed completed values of the children of node, so that their softmax
+        is the improved policy, with -inf for unsampled actions
+        """
+        visits = self.child_visits(node)
+        with np.errstate(divide="ignore"):
+            logits = np.log(self.priors[node])
+        # The weight of the values grows with the number of visits, following Gumbel MuZero
+        sigma = (
+            (self.config["gumbel_c_visit"] + visits.max())
+            * self.config["gumbel_c_scale"]
+            * self.completed_q(node)
+        )
+        return logits + sigma
+
+    def improved_policy(self, node=0):
+        scores = self.gumbel_scores(node)
+        policy = np.exp(scores - scores.max())
+        return policy / policy.sum()
 
-    def action_score(self, action_n, total_visit_count, action_idx=None):
+    def gumbel_root_action(self, considered_visit=None):
+        """
+        Picks the action to visit from the root with sequential halving: out of the actions whose visit count
+        is the one given for this simulation by the considered_visits schedule, the one with the highest
+        Gumbel noise plus gumbel_scores. The top gumbel_top_k actions by Gumbel noise plus log prior are
+        the ones considered, as these are the only ones visited during the first phase.
+        With considered_visit as the highest visit count this is the action to play.
         """
-        Scoring function for the different potential actions, following the formula in Appendix B of muzero
+        visits = self.child_visits(0) + self.virtual_losses[0]
+        scores = self.root_gumbel + self.gumbel_scores(0)
+
+        if considered_visit is None:
+            n_valid = np.count_nonzero(self.priors[0] > 0)
+            n_considered = min(self.config["gumbel_top_k"], n_valid)
+            schedule = considered_visits(n_considered, self.config["n_simulations"])
+            # A reused tree can have more visits than the schedule holds
+            considered_visit = schedule[min(int(visits.sum()), len(schedule) - 1)]
+
+        considered = visits == considered_visit
+        if considered.any():
+            scores = np.where(considered, scores, -np.inf)
+        return int(np.argmax(scores))
+
+    def action_scores(self, node):
+        """
+        Scores all of the potential actions from node at once, following the formula in Appendix B of muzero
         """
         c1 = 1.25
         c2 = 19652
 
-        child = self.children[action_n]
-
-        n = child.num_visits if child else 0
+        children = self.children[node]
+        explored = children != -1
 
-        val = self.minmax.normalize(child.average_val) if child else 0
+        n = np.where(explored, self.visit_counts[children], 0)
+        total_visit_count = n.sum()
 
-        # p here is the prior - the expectation of what the the policy will look like
-        if self.action_dim > 1:
-            prior = reduce(mul, [ self.pol_pred[i][int(action_idx_comp)] for i, action_idx_comp in enumerate(action_idx) ]) # Faster equivalent to np.prod()
-        elif self.action_dim == 1:
-            prior = self.pol_pred[action_n]
+        val = np.where(explored, self.minmax.normalize(self.average_vals[children]), 0)
 
-        # prior = torch.tensor(0.5)
+        # Virtual losses count as extra visits which returned a normalized value of 0
+        virtual_losses = self.virtual_losses[node]
+        if virtual_losses.any():
+            val = val * n / np.maximum(n + virtual_losses, 1)
+            n = n + virtual_losses
+            total_visit_count = n.sum()
 
-        # with open("debug.log", 'a') as logfile:
-        #     print("Action:", action_n, file=logfile)
-        #     print("Value:", val, file=logfile)
-        #     print("Policy prior:", prior, file=logfile)
+        # p here is the prior - the expectation of what the the policy will look like
+        prior = self.priors[node]
 
         # This term increases the prior on those actions which have been taken only a small fraction
         # of the current number of visits to this node
@@ -349,98 +806,156 @@ class TreeNode:
         # Its utility is questionable, because with on the order of 100 simulations, this term will always be
         # close to 1.
         balance_term = c1 + math.log((total_visit_count + c2 + 1) / c2)
-        score = val + (prior * explore_term * balance_term)
-        
-        return score
-
-    def pick_action(self):
+        scores = val + (prior * explore_term * balance_term)
+
+        if self.n_sampled:
+            # The unused slots are at the end, after the sampled actions sorted by decreasing prior
+            n_open = np.count_nonzero(self.slot_actions[node] != -1)
+            if self.config["widening_factor"]:
+                n_widened = self.config["widening_factor"] * (
+                    total_visit_count ** self.config["widening_exponent"]
+                )
+                n_open = min(n_open, max(1, math.ceil(n_widened)))
+            scores[n_open:] = -np.inf
+        return scores
+
+    def pick_action(self, node):
         """Gets the score each of the potential actions and picks the one with the highest"""
-        
+
         print_timing("Start picking action (search)", self.config)
-        
-        if self.action_dim > 1:
-            total_visit_count = sum([a.num_visits if a else 0 for a in self.children.values()])
-            scores = {
-                a_str:self.action_score(a_str, total_visit_count, a_idx) 
-                for a_idx, a_str in zip(self.possible_action_indices, self.possible_actions_str)
-            }
-        elif self.action_dim == 1:
-            total_visit_count = sum([a.num_visits if a else 0 for a in self.children])
-            scores = {
-                a:self.action_score(a, total_visit_count) 
-                for a in self.possible_actions
-            }
-
-        maxscore = max(scores.values())
+
+        if node == 0 and self.config["gumbel_root"]:
+            return self.gumbel_root_action()
+
+        scores = self.action_scores(node)
+        best_actions = np.flatnonzero(scores == scores.max())
 
         # Need to be careful not to always pick the first action as it common that two are scored identically
-        if self.action_dim > 1:
-            action = np.random.choice(
-                [a for a in self.possible_actions_str if scores[a] == maxscore]
-            )
-        elif self.action_dim == 1:
-            action = np.random.choice(
-                [a for a in self.possible_actions if scores[a] == maxscore]
-            )
-            
+        if len(best_actions) > 1:
+            action = np.random.choice(best_actions)
+        else:
+            action = best_actions[0]
+
         print_timing("Finish picking action (search)", self.config)
-        
+
         return action
 
     def pick_game_action(self, temperature):
         """
-        Picks the action to actually be taken in game,
-        taken by the root node after the full tree has been generated.
-        Note that it only uses the visit counts, rather than the score or prior,
-        these impact the decision only through their impact on where to visit
+        Picks the action to actually be taken in game, once the full tree has been generated.
+        Note that it only uses the visit counts of the children of the root, rather than the score
+        or prior, these impact the decision only through their impact on where to visit
         """
+        visit_counts = self.child_visits()
 
-        if self.action_dim > 1:
-            visit_counts = {action:node.num_visits if node else 0 for action, node in self.children.items()}
-        elif self.action_dim == 1:
-            visit_counts = {action:node.num_visits if node else 0 for action, node in enumerate(self.children)}
-
-        # zero temperature means always picking the highest visit count
-        if temperature == 0:
-            max_vis = max(visit_counts.values())
-            scores = {action:1 if vc == max_vis else 0 for action, vc in visit_counts.items()}
-            total_score = sum(scores.values())
-            adjusted_scores = [score / total_score for score in scores.values()]
-            if self.action_dim > 1:
-                action = np.random.choice(self.possible_actions_str, p=adjusted_scores)
-            elif self.action_dim == 1:
-                action = np.random.choice(self.possible_actions, p=adjusted_scores)
-            else:
-            	raise("Incorrect number of action dimensions.")
-
-        # If temperature is non-zero, raise (visit_count + 1) to power (1 / T)
-        # scale these to a probability distribution and use to select action
+        # With Gumbel MuZero the action played is the winner of the sequential halving,
+        # which is already sampled through the Gumbel noise
+        if self.config["gumbel_root"]:
+            slot = self.gumbel_root_action(considered_visit=visit_counts.max())
         else:
-            # scores = [(vc + 1) ** (1 / temperature) for vc in visit_counts]
-            scores = {action:(vc + 1) ** (1 / temperature) for action, vc in visit_counts.items()}
-            total_score = sum(scores.values())
-            adjusted_scores = [score / total_score for score in scores.values()]
-
-            if self.action_dim > 1:
-                action = np.random.choice(self.possible_actions_str, p=adjusted_scores)
-            elif self.action_dim == 1:
-                action = np.random.choice(self.possible_actions, p=adjusted_scores)
+            # zero temperature means always picking the highest visit count
+            if temperature == 0:
+                scores = (visit_counts == visit_counts.max()).astype(np.float64)
+
+            # If temperature is non-zero, raise (visit_count + 1) to power (1 / T)
+            # scale these to a probability distribution and use to select action
             else:
-            	raise("Incorrect number of action dimensions.")
+                scores = (visit_counts + 1) ** (1 / temperature)
+            if self.n_sampled:
+                scores[self.slot_actions[0] == -1] = 0
+            adjusted_scores = scores / scores.sum()
+
+            slot = np.random.choice(self.n_slots, p=adjusted_scores)
+        action = self.slot_action(0, slot)
 
         # Prints a lot of useful information for how the algorithm is making decisions
         if self.config["debug"]:
-            if self.action_dim > 1:
-                val_preds = [c.val_pred if c else 0 for c in self.children.values()]
-            else:
-                val_preds = [c.val_pred if c else 0 for c in self.children]
-            print("(Debug) Visit Counts:", visit_counts)
+            children = self.children[0]
+            val_preds = np.where(children != -1, self.val_preds[children], 0)
+            actions = [self.slot_action(0, slot) for slot in range(self.n_slots)]
+            print("(Debug) Visit Counts:", dict(zip(actions, visit_counts.tolist())))
             print("(Debug) Node val_pred:", self.val_pred)
-            print("(Debug) Children val_pred:", val_preds)
+            print("(Debug) Children val_pred:", val_preds.tolist())
 
         return action
 
 
+class SearchTracer:
+    """
+    Records every simulation of the searches it is passed to: the depth it reached, the action it
+    expanded, the time taken by the batched model call which expanded it and the size of that batch.
+    Only the last max_records simulations are kept, in a ring buffer.
+    """
+
+    enabled = True
+
+    def __init__(self, max_records=10_000):
+        self.records = deque(maxlen=max_records)
+        self.total_records = 0  # Simulations recorded since the tracer was created
+        self.summarized_records = 0  # Value of total_records at the last call to summarize
+
+    def record(self, depth, action, model_time, batch_size):
+        self.records.append((depth, int(action), model_time, batch_size))
+        self.total_records += 1
+
+    def dump(self, path=None):
+        """Returns the records held in the buffer as a list of dicts, also pickling them to path if given"""
+        records = [
+            {"depth": depth, "action": action, "model_time": model_time, "batch_size": batch_size}
+            for depth, action, model_time, batch_size in self.records
+        ]
+        if path:
+            with open(path, "wb") as f:
+                pickle.dump(records, f)
+        return records
+
+    def summarize(self, writer, step):
+        """Writes the simulations recorded since the last summary to a tensorboard SummaryWriter"""
+        n_new = min(self.total_records - self.summarized_records, len(self.records))
+        self.summarized_records = self.total_records
+        if n_new == 0:
+            return
+
+        depths, _, model_times, batch_sizes = zip(*list(self.records)[-n_new:])
+        writer.add_histogram("Search/depth", np.array(depths), step)
+        writer.add_scalar("Search/mean_depth", np.mean(depths), step)
+        writer.add_scalar("Search/max_depth", max(depths), step)
+        # Each model call is shared by the whole batch of simulations it expanded
+        writer.add_scalar(
+            "Search/model_time_per_simulation",
+            np.mean(np.array(model_times) / np.array(batch_sizes)),
+            step,
+        )
+        writer.add_scalar("Search/mean_batch_size", np.mean(batch_sizes), step)
+
+    def clear(self):
+        self.records.clear()
+
+
+class NullTracer:
+    """Tracer used when search tracing is off, which records nothing"""
+
+    enabled = False
+
+    def record(self, depth, action, model_time, batch_size):
+        pass
+
+    def dump(self, path=None):
+        return []
+
+    def summarize(self, writer, step):
+        pass
+
+    def clear(self):
+        pass
+
+
+def make_tracer(config):
+    if config["trace_search"]:
+        return SearchTracer(max_records=config["trace_buffer_size"])
+    return NullTracer()
+
+
 class MinMax:
     """
     This class tracks the smallest and largest values that have been seen
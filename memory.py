@@ -1,5 +1,6 @@
 import os
 import pickle
+import threading
 import time
 import yaml
 
@@ -28,10 +29,18 @@ class GameRecord:
         self.discount = discount  # Discount rate to be applied to future rewards
 
         # List of states received from the game
-        if self.config["exp_name"] == "cartpole-nec":
+        # init_frame is None for a record whose observations are filled in afterwards
+        if init_frame is None:
+            self.observations = []
+        elif self.config["exp_name"] == "cartpole-nec":
             self.observations = [(convert_to_int(init_frame[0], 
                                                 self.config["obs_type"]),
                                  init_frame[1])]
+        elif self.config["obs_type"] == "image":
+            # The frames of image games are kept in one contiguous array, observations being a view of
+            # the frames so far, so the stacks of the last frames are built from it without copying frames
+            self.observations = np.empty((0, *init_frame.shape), dtype=np.ubyte)
+            self.add_frame(convert_to_int(init_frame, self.config["obs_type"]))
         else:
             self.observations = [convert_to_int(init_frame, self.config["obs_type"])]
 
@@ -47,13 +56,9 @@ class GameRecord:
 
         self.priorities = []
         self.last_analysed = last_analysed
-        
-        if config["obs_type"] == "bipedalwalker":
-            # Contains the inverse function for the list dim_action_values, which has the possible values for the action 
-            self.dim_value_index_map = {v: i for i, v in enumerate(config["dim_action_values"])}
 
     def add_step(self, obs: np.ndarray, action: int, reward: int, root):
-        # Root is a TreeNode object at the root of the search tree for the given state
+        # Root is the SearchTree built by search for the given state
 
         # Note that when taking a step you get the action, reward and new observation
         # but for training purposes we want to connect the reward with the action and *old* observation.
@@ -63,76 +68,57 @@ class GameRecord:
         if self.config["exp_name"] == "cartpole-nec":
             int_obs = convert_to_int(obs[0], self.config["obs_type"])
             self.observations.append((int_obs, obs[1]))
+        elif self.config["obs_type"] == "image":
+            self.add_frame(convert_to_int(obs, self.config["obs_type"]))
         else:
             int_obs = convert_to_int(obs, self.config["obs_type"])
             self.observations.append(int_obs)
         self.actions.append(action)
         self.rewards.append(float(reward))
 
-        if self.config["action_dim"] > 1:
-            #self.search_stats.append([c.num_visits if c else 0 for c in root.children.values()])
-            action_selection_info = [ [0 for _ in range(self.config["action_size"])] for _ in range(self.config["action_dim"]) ]
-            for action_str, node in root.children.items():
-            	if node:
-            		a = eval(action_str)
-            		for i, a_comp in enumerate(a):
-            			action_selection_info[i][self.dim_value_index_map[a_comp]] += node.num_visits
-            self.search_stats.append(action_selection_info)
-            #print("Search Stats:" + str(self.search_stats))
-        elif self.config["action_dim"] == 1:
-        	self.search_stats.append([c.num_visits if c else 0 for c in root.children])
-        	
-        self.values.append(float(root.average_val))
+        search_stat, value = root_stats(self.config, root)
+        self.search_stats.append(search_stat)
+        self.values.append(value)
+
+    def add_frame(self, frame):
+        # The array behind the view is doubled when it's full, so appending frames is amortised O(1)
+        n_frames = len(self.observations)
+        frames = self.observations.base
+        if not isinstance(frames, np.ndarray) or len(frames) == n_frames:
+            frames = np.empty((max(1, 2 * n_frames), *frame.shape), dtype=np.ubyte)
+            frames[:n_frames] = self.observations
+        frames[n_frames] = frame
+        self.observations = frames[: n_frames + 1]
 
     def get_last_n(self, n=None, pos=-1):
+        """
+        The input of the network at pos: a plane for each of the last n actions, followed by the last n frames,
+        with zeros in place of actions and frames from before the start of the game
+        """
         if not n:
             n = self.config["last_n_frames"]
 
         if pos == -1:
-            last_n = np.concatenate(self.observations[-n:], axis=0)
-            last_n_actions = self.actions[-n:]
+            frames = self.observations[-n:]
+            actions = self.actions[-n:]
         else:
-            last_n = np.concatenate(
-                self.observations[max(0, pos - n + 1) : pos + 1], axis=0
-            )
-            last_n_actions = self.actions[max(0, pos - n + 1) : pos + 1]
-
-        last_n = convert_from_int(last_n, self.config["obs_type"])
-
-        last_n_actions = [-1] * (n - len(last_n_actions)) + last_n_actions
-        last_n_actions = torch.tensor(last_n_actions, dtype=torch.float32) + 1
-        last_n_actions /= self.action_size
-
-        action_planes = torch.ones(last_n.shape[1:])
-        action_planes = torch.einsum("hw, a->ahw", [action_planes, last_n_actions])
-
-        pad_len = (n * 3) - last_n.shape[0]
-        pad_a = np.zeros((pad_len, *last_n.shape[1:]))
-        last_n = np.concatenate((action_planes, pad_a, last_n), axis=0)
+            frames = self.observations[max(0, pos - n + 1) : pos + 1]
+            actions = self.actions[max(0, pos - n + 1) : pos + 1]
+
+        n_channels, height, width = frames.shape[1:]
+        last_n = np.zeros((n * (n_channels + 1), height, width), dtype=np.float32)
+        # The action planes are the actions broadcast over the frame
+        action_planes = last_n[n - len(actions) : n]
+        action_planes[:] = ((np.array(actions, dtype=np.float32) + 1) / self.action_size)[:, None, None]
+        # The frames are a view of the frames of the game, laid out as channels, which is converted once
+        last_n[len(last_n) - frames.size // (height * width) :] = convert_from_int(
+            frames.reshape(-1, height, width), self.config["obs_type"]
+        )
         return last_n
 
     def add_priorities(self, n_steps=5, reanalysing=False):
-        # Add this in case trainer has restarted before adding priorities
-        if len(self.values) != len(self.priorities):
-            self.priorities = []
-            reanalysing = False
-
-        for i, r in enumerate(self.values):
-            if i + n_steps < len(self.values):
-                value_target = self.values[i + n_steps]
-            else:
-                value_target = 0
-            for j in range(n_steps):
-                if len(self.values) < i + j:
-                    value_target += self.values[i + j]
-                else:
-                    break
-
-            priority = abs(r - value_target)
-            if reanalysing:
-                self.priorities[i] = priority
-            else:
-                self.priorities.append(priority)
+        # Every priority is recomputed, so this also covers the trainer having restarted before adding priorities
+        self.priorities = value_priorities(self.values, n_steps).tolist()
 
     def pad_target(self, target_l, pad_len):
         # print(target_l)
@@ -248,6 +234,43 @@ class GameRecord:
             )
 
 
+def root_stats(config, root):
+    """The search stats and value stored for a step, from the SearchTree of its search"""
+    # The policy target of the search, the visit counts or the improved policy with gumbel_root
+    if config["action_dim"] > 1:
+        # Visits are counted separately for the value taken in each dimension of the action
+        search_stat = root.search_policy().tolist()
+    else:
+        search_stat = root.search_policy()[0].tolist()
+    return search_stat, float(root.average_val)
+
+
+def value_priorities(values, n_steps=5):
+    """The priority of each step of a game, the gap between its value and the value n_steps later (0 past the end)"""
+    values = np.asarray(values, dtype=np.float64)
+    value_targets = np.zeros_like(values)
+    value_targets[: max(0, len(values) - n_steps)] = values[n_steps:]
+    return np.abs(values - value_targets)
+
+
+class CounterSubscriber:
+    """
+    Mixin for actors which read the run counters of Memory: games, frames, batches and whether the run is finished.
+    Memory pushes the counters to its subscribers whenever they change, so reading self.counters doesn't cost
+    a call to Memory. The pushes arrive while the loops of the actor are running, so it needs a max_concurrency above 1
+    """
+
+    counters = None
+    counters_lock = threading.Lock()
+
+    def update_counters(self, counters):
+        # Pushes aren't guaranteed to run in order, and can race with counters the actor got itself,
+        # so older counters are ignored
+        with self.counters_lock:
+            if self.counters is None or counters["version"] > self.counters["version"]:
+                self.counters = counters
+
+
 @ray.remote
 class Memory:
     def __init__(self, config, log_dir):
@@ -268,6 +291,10 @@ class Memory:
         self.finished = False
         self.game_stats = []
 
+        # Actors which are pushed the counters whenever they change, see CounterSubscriber
+        self.subscribers = []
+        self.counters_version = 0
+
     def get_data(self):
         return {
             "games": self.total_games,
@@ -275,6 +302,20 @@ class Memory:
             "batches": self.total_batches,
         }
 
+    def get_counters(self):
+        return {**self.get_data(), "finished": self.finished, "version": self.counters_version}
+
+    def subscribe(self, actor):
+        """Adds an actor with the CounterSubscriber mixin to the subscribers, waiting until it has the counters"""
+        self.subscribers.append(actor)
+        ray.get(actor.update_counters.remote(self.get_counters()))
+
+    def publish_counters(self):
+        self.counters_version += 1
+        counters = self.get_counters()
+        for actor in self.subscribers:
+            actor.update_counters.remote(counters)
+
     def get_minmax(self):
         return self.minmax
 
@@ -346,11 +387,14 @@ class Memory:
             print("Reached designated end of run, sending shutdown message")
             self.finished = True
 
-        return self.get_data()
+        self.publish_counters()
+        # The counters are also returned, so that the player has them before the push arrives
+        return self.get_counters()
 
     def done_batch(self):
         self.total_batches += 1
         self.save_core_stats()
+        self.publish_counters()
 
     def save_core_stats(self, total_batches=None):
         stat_dict = {
@@ -1,3 +1,4 @@
+import functools
 import math
 
 import numpy as np
@@ -11,8 +12,6 @@ import cv2
 
 from dnd_kdtree import DND
 
-from itertools import product
-
 
 def conv3x3(in_channels, out_channels, stride=1):
     return torch.nn.Conv2d(
@@ -45,6 +44,52 @@ class ResBlockSmall(torch.nn.Module):
         return out
 
 
+class MuZeroInference:
+    """
+    The inference steps of search, shared by the MuZero networks. Each applies a network function
+    and then the prediction function, converting their outputs so that search only makes one call per step:
+    the policy logits become probabilities, and the values and rewards become scalars from their support
+    """
+
+    def initial_inference(self, observation):
+        """Returns the latents, the policy probabilities and the scalar values of a batch of observations"""
+        latent = self.represent(observation)
+        policy_logits, value = self.predict(latent)
+        return latent, torch.softmax(policy_logits, -1), self.value_to_scalar(value)
+
+    def recurrent_inference(self, latent, action, hiddens=None):
+        """
+        Returns the new latents, the scalar rewards (value prefixes when using value_prefix),
+        the scalar values, the policy probabilities and the new LSTM hiddens (or None)
+        """
+        if self.config["value_prefix"]:
+            new_latent, reward, new_hiddens = self.dynamics(latent, action, hiddens)
+        else:
+            new_latent, reward = self.dynamics(latent, action)
+            new_hiddens = None
+
+        policy_logits, value = self.predict(new_latent)
+        reward = self.support_transform(reward.device).to_scalar(torch.softmax(reward, 1))
+        return (
+            new_latent,
+            reward,
+            self.value_to_scalar(value),
+            torch.softmax(policy_logits, -1),
+            new_hiddens,
+        )
+
+    def value_to_scalar(self, value):
+        # Current NEC implementation does not use supported codomain
+        if self.config["nec"]:
+            return value
+        return self.support_transform(value.device).to_scalar(torch.softmax(value, 1))
+
+    def support_transform(self, device):
+        return get_support_transform(
+            self.config["support_width"], device, check=self.config["check_supports"]
+        )
+
+
 class CartRepr(nn.Module):
     def __init__(self, obs_size, latent_size):
         super().__init__()
@@ -137,7 +182,7 @@ class CartPred(nn.Module):
         return policy_logits, value_logits
 
 
-class MuZeroCartNet(nn.Module):
+class MuZeroCartNet(MuZeroInference, nn.Module):
     def __init__(self, action_size: int, obs_size, config: dict):
         super().__init__()
         self.config = config
@@ -285,7 +330,7 @@ class CartNECPred(nn.Module):
         return policy_logits, value_logits
         
         
-class MuZeroNECCartNet(nn.Module):
+class MuZeroNECCartNet(MuZeroInference, nn.Module):
 	# If a weights_path is passed, the weights of a pretrained MuZeroCartNet are 
 	# loaded from that path into the compatible layers of this network
     def __init__(self, action_size: int, obs_size, config: dict, 
@@ -505,7 +550,7 @@ class BipedalPred(nn.Module):
         return policy_logits, value_logits
         
 
-class MuZeroBipedalNet(nn.Module):
+class MuZeroBipedalNet(MuZeroInference, nn.Module):
     def __init__(self, action_size: int, action_dim: int, obs_size, config: dict):
         super().__init__()
         self.config = config
@@ -515,13 +560,10 @@ class MuZeroBipedalNet(nn.Module):
         self.latent_size = config["latent_size"]
         self.support_width = config["support_width"]
 
-        dim_action_values = config["dim_action_values"]
-        self.possible_actions = [ [dim_action_values[action_n_comp] for action_n_comp in action_n]
-                                for action_n in product(range(self.action_size), repeat=self.action_dim) ]
-        self.possible_actions_str = [ repr(action) for action in self.possible_actions ]
-        self.possible_action_indices = [ action_idx for action_idx 
-                                         in product(range(self.action_size), 
-                                                    repeat=self.action_dim) ]
+        # Joint actions are encoded as integers, whose digits in base action_size are the index
+        # of the value taken in each dimension, see decode_actions
+        self.dim_action_values = np.array(config["dim_action_values"])
+        self.possible_actions = range(self.action_size ** self.action_dim)
 
         self.pred_net = BipedalPred(self.action_size, self.action_dim, self.latent_size, self.support_width)
 
@@ -577,9 +619,14 @@ class MuZeroBipedalNet(nn.Module):
     def represent(self, observation):
         latent = self.repr_net(observation)
         return latent
+
+    def decode_actions(self, actions):
+        """Turns integer joint actions into the value taken in each dimension, as passed to the environment"""
+        dim_ndxs = np.unravel_index(actions, (self.action_size,) * self.action_dim)
+        return self.dim_action_values[np.stack(dim_ndxs, axis=-1)]
         
 
-class MuZeroAtariNet(nn.Module):
+class MuZeroAtariNet(MuZeroInference, nn.Module):
     def __init__(self, action_size, obs_size, config):
         super().__init__()
         self.config = config
@@ -982,7 +1029,7 @@ class AtariPredictionNet(nn.Module):
         return policy_logits, value_logits
 
 
-class TestNet(nn.Module):
+class TestNet(MuZeroInference, nn.Module):
     def __init__(self, action_size, obs_size, config):
         super().__init__()
         self.config = config
@@ -1078,61 +1125,93 @@ class TestPredictionNet(nn.Module):
         return policy_logits, value_logits
 
 
-def support_to_scalar(support, epsilon=0.00001):
-    squeeze = False
-    if support.ndim == 1:
-        squeeze = True
-        support.unsqueeze_(0)
+class SupportTransform:
+    """
+    Converts between scalars and their categorical support, as found in Appendix F of MuZero,
+    for a support running from -half_width to half_width on a given device. The support vector is
+    built once, so use get_support_transform to share a single transform between search and training.
 
-    if not all(abs(torch.sum(support, dim=1)) - 1 < 0.01):
-        print(support)
+    With check, which is meant for debugging as it syncs with the device,
+    the supports taken or returned are checked to sum to 1.
+    """
 
-    half_width = int((support.shape[1] - 1) / 2)
-    vals = torch.tensor(
-        range(-half_width, half_width + 1), dtype=support.dtype, device=support.device
-    )
+    def __init__(self, half_width, device=torch.device("cpu"), epsilon=0.00001, check=False):
+        self.half_width = half_width
+        self.device = device
+        self.epsilon = epsilon
+        self.check = check
+        self.support = torch.arange(
+            -half_width, half_width + 1, dtype=torch.float32, device=device
+        )
 
-    # Dot product of the two
-    out_val = torch.einsum("i,bi -> b", [vals, support])
+    def check_support(self, support, tolerance):
+        if self.check and not torch.all(torch.abs(support.sum(dim=1) - 1) < tolerance):
+            raise ValueError(f"Supports which don't sum to 1: {support}")
 
-    sign_out = torch.where(out_val >= 0, 1, -1)
+    def to_scalar(self, support):
+        """Decodes a batch of supports of shape (batch, 2 * half_width + 1) into a batch of scalars"""
+        self.check_support(support, 0.01)
+        vals = self.support.to(dtype=support.dtype)
 
-    num = torch.sqrt(1 + 4 * epsilon * (torch.abs(out_val) + 1 + epsilon)) - 1
-    res = (num / (2 * epsilon)) ** 2
+        # Dot product of the two
+        out_val = support @ vals
 
-    output = sign_out * (res - 1)
+        sign_out = torch.where(out_val >= 0, 1, -1)
 
-    if squeeze:
-        output.squeeze_(0)
+        num = torch.sqrt(1 + 4 * self.epsilon * (torch.abs(out_val) + 1 + self.epsilon)) - 1
+        res = (num / (2 * self.epsilon)) ** 2
 
-    return output
+        return sign_out * (res - 1)
 
+    def to_support(self, scalar):
+        """Encodes a batch of scalars into a batch of supports of shape (batch, 2 * half_width + 1)"""
+        # Scaling the value function and converting to discrete support as found in
+        # Appendix F if MuZero
+        half_width = self.half_width
+        sign_x = torch.where(scalar >= 0, 1, -1)
+        h_x = sign_x * (torch.sqrt(torch.abs(scalar) + 1) - 1 + self.epsilon * scalar)
 
-def scalar_to_support(scalar: torch.Tensor, epsilon=0.00001, half_width: int = 10):
-    # Scaling the value function and converting to discrete support as found in
-    # Appendix F if MuZero
-    squeeze = False
-    if scalar.ndim == 0:
-        scalar.unsqueeze_(0)
-        squeeze = True
+        h_x = h_x.clamp(-half_width, half_width)
+
+        upper_ndxs = (torch.ceil(h_x) + half_width).to(dtype=torch.int64)
+        lower_ndxs = (torch.floor(h_x) + half_width).to(dtype=torch.int64)
+        ratio = h_x % 1
+        support = torch.zeros(*scalar.shape, 2 * half_width + 1, device=scalar.device)
+
+        support.scatter_(1, upper_ndxs.unsqueeze(1), ratio.unsqueeze(1))
+        # do lower ndxs second as if lower==upper, ratio = 0, 1 - ratio = 1
+        support.scatter_(1, lower_ndxs.unsqueeze(1), (1 - ratio).unsqueeze(1))
+
+        self.check_support(support, 0.0001)
+        return support
+
+
+@functools.lru_cache(maxsize=None)
+def get_support_transform(half_width, device=torch.device("cpu"), epsilon=0.00001, check=False):
+    """The SupportTransform for a support width and device, which is only created once"""
+    return SupportTransform(half_width, torch.device(device), epsilon, check)
 
-    sign_x = torch.where(scalar >= 0, 1, -1)
-    h_x = sign_x * (torch.sqrt(torch.abs(scalar) + 1) - 1 + epsilon * scalar)
 
-    h_x.clamp_(-half_width, half_width)
+def support_to_scalar(support, epsilon=0.00001):
+    squeeze = support.ndim == 1
+    if squeeze:
+        support = support.unsqueeze(0)
 
-    upper_ndxs = (torch.ceil(h_x) + half_width).to(dtype=torch.int64)
-    lower_ndxs = (torch.floor(h_x) + half_width).to(dtype=torch.int64)
-    ratio = h_x % 1
-    support = torch.zeros(*scalar.shape, 2 * half_width + 1, device=scalar.device)
+    half_width = (support.shape[1] - 1) // 2
+    output = get_support_transform(half_width, support.device, epsilon).to_scalar(support)
 
-    support.scatter_(1, upper_ndxs.unsqueeze(1), ratio.unsqueeze(1))
-    # do lower ndxs second as if lower==upper, ratio = 0, 1 - ratio = 1
-    support.scatter_(1, lower_ndxs.unsqueeze(1), (1 - ratio).unsqueeze(1))
+    if squeeze:
+        output = output.squeeze(0)
+    return output
 
-    assert all(abs(torch.sum(support, dim=1) - 1) < 0.0001)
 
+def scalar_to_support(scalar: torch.Tensor, epsilon=0.00001, half_width: int = 10):
+    squeeze = scalar.ndim == 0
     if squeeze:
-        support.squeeze_(0)
+        scalar = scalar.unsqueeze(0)
+
+    support = get_support_transform(half_width, scalar.device, epsilon).to_support(scalar)
 
+    if squeeze:
+        support = support.squeeze(0)
     return support
@@ -14,31 +14,38 @@ from torch import nn
 
 from torch.utils.tensorboard import SummaryWriter
 
-from memory import GameRecord, save_model, load_model
+from memory import CounterSubscriber, GameRecord, save_model, load_model
 from models import scalar_to_support, support_to_scalar
-from mcts import search
+from mcts import search, make_tracer
 
 
-@ray.remote
-class Player:
+@ray.remote(max_concurrency=2)
+class Player(CounterSubscriber):
     def __init__(self, log_dir, writer=None):
         self.log_dir = log_dir
         self.writer = writer
+        self.tracer = None
 
     def play(self, config, mu_net, device, log_dir, memory, buffer, env):
         minmax = ray.get(memory.get_minmax.remote())
         start_time = time.time()
         updated_lr = False
 
-        while not ray.get(memory.is_finished.remote()):
-            data = ray.get(memory.get_data.remote())
+        self.tracer = make_tracer(config)
+        if self.tracer.enabled and not self.writer:
+            self.writer = SummaryWriter(log_dir=log_dir)
+
+        while not self.counters["finished"]:
+            data = self.counters
             self.total_games = data["games"]
             self.total_frames = data["frames"]
 
-            if "latest_model_dict.pt" in os.listdir(log_dir):
+            # With an InferenceServer, the server holds the model and keeps it up to date
+            local_model = isinstance(mu_net, nn.Module)
+            if local_model and "latest_model_dict.pt" in os.listdir(log_dir):
                 mu_net = ray.get(memory.load_model.remote(log_dir, mu_net))
                 # mu_net = load_model(log_dir, mu_net, config)
-            else:
+            elif local_model:
                 memory.save_model.remote(mu_net, log_dir)
                 # save_model(mu_net, log_dir, config)
 
@@ -69,16 +76,18 @@ class Player:
             #     )
             #     mu_net.init_optim(learning_rate)
 
-            if self.total_frames == 0:
+            if local_model and self.total_frames == 0:
                 learning_rate = config["initial_learning_rate"]
                 mu_net.init_optim(learning_rate)
-            elif self.total_frames >= config["tr_steps_before_lr_decay"] and not updated_lr:
+            elif local_model and self.total_frames >= config["tr_steps_before_lr_decay"] and not updated_lr:
                 learning_rate = config["final_learning_rate"]
                 updated_lr = True
                 mu_net.init_optim(learning_rate)
 
 
             vals = []
+            simulations = []
+            tree = None
             game_start_time = time.time()
             while not over and frames < config["max_frames"]:
                 if config["obs_type"] == "image":
@@ -91,20 +100,30 @@ class Player:
                     else:
                         frame_input = frame
                 tree = search(
-                    config, mu_net, frame_input, minmax, device=device
+                    config,
+                    mu_net,
+                    frame_input,
+                    minmax,
+                    device=device,
+                    tree=tree,
+                    tracer=self.tracer,
                 )
 
-                action = tree.pick_game_action(temperature=temperature)
+                action_ndx = tree.pick_game_action(temperature=temperature)
                 if config["debug"]:
-                    if tree.children[action]:
-                        print("(Debug) Picked Action Reward:", float(tree.children[action].reward))
+                    slot = tree.action_slot(action_ndx)
+                    child = tree.children[0, slot] if slot is not None else -1
+                    if child != -1:
+                        print("(Debug) Picked Action Reward:", float(tree.rewards[child]))
 
                 if config["render"]:
                     env.render("human")
 
-                # In BipedalWalker the action is represented in the MCTS as a string
+                # In BipedalWalker the MCTS picks the index of a joint action, decoded into the value of each dimension
                 if config["obs_type"] == "bipedalwalker":
-                    action = eval(action)
+                    action = mu_net.decode_actions(action_ndx).tolist()
+                else:
+                    action = action_ndx
 
                 frame, reward, terminated, truncated, _ = env.step(action, return_render=config["nec"])
                 over = terminated or truncated
@@ -116,20 +135,42 @@ class Player:
                 frames += 1
                 score += reward
                 vals.append(float(tree.val_pred))
+                simulations.append(tree.simulations_run)
+
+                # Keep the subtree below the action taken, so the next search only has to spend
+                # the simulations that haven't already been run from the new state
+                if config["reuse_tree"]:
+                    tree = tree.subtree(action_ndx)
+                else:
+                    tree = None
 
             time_per_move = (time.time() - game_start_time) / frames
 
             game_record.add_priorities(n_steps=config["reward_depth"])
-            stats = ray.get(memory.get_data.remote())
+            stats = self.counters
             if self.writer:
                 self.writer.add_scalar("score", score, stats["frames"])
+                self.writer.add_scalar(
+                    "Search/simulations_per_move", np.mean(simulations), stats["frames"]
+                )
+                self.tracer.summarize(self.writer, stats["frames"])
 
             game_data = ray.get(memory.done_game.remote(frames, score))
-            buffer.save_game.remote(game_record, frames, score, game_data)
+            # The next game starts from the counters after this one, without waiting for Memory's push
+            self.update_counters(game_data)
+            self.total_games = game_data["games"]
+            self.total_frames = game_data["frames"]
+            buffer.save_game(game_record, frames, score, game_data)
 
             print(
-                f"Game: {self.total_games + 1:4}. Total frames: {self.total_frames + frames:6}. "
+                f"Game: {self.total_games:4}. Total frames: {self.total_frames:6}. "
                 + f"Time: {str(datetime.timedelta(seconds=int(time.time() - start_time)))}. Score: {score:6}. "
                 + f"Value mean, std: {np.mean(np.array(vals)):6.2f}, {np.std(np.array(vals)):5.2f}. "
-                + f"s/move: {time_per_move:5.3f}."
+                + f"s/move: {time_per_move:5.3f}. Simulations/move: {np.mean(simulations):5.1f}."
             )
+
+    def dump_search_trace(self, path=None):
+        """Returns the simulations recorded by the search tracer, see mcts.SearchTracer.dump"""
+        if self.tracer is None:
+            return []
+        return self.tracer.dump(path)
@@ -4,70 +4,68 @@ import time
 import numpy as np
 import ray
 import torch
+from torch import nn
 
-from mcts import search, MinMax
-from utils import convert_to_int, convert_from_int
-from memory import load_model
+from mcts import search_batch
+from memory import CounterSubscriber, root_stats
 
-@ray.remote
-class Reanalyser:
+@ray.remote(max_concurrency=2)
+class Reanalyser(CounterSubscriber):
     def __init__(self, config, log_dir, device=torch.device("cpu")):
         self.device = device
         self.config = config
         self.log_dir = log_dir
 
     def reanalyse(self, mu_net, memory, buffer):
-        while not ray.get(memory.is_finished.remote()):
-            if "latest_model_dict.pt" in os.listdir(self.log_dir):
+        # With an InferenceServer, the server holds the model and keeps it up to date
+        local_model = isinstance(mu_net, nn.Module)
+        while not self.counters["finished"]:
+            if local_model and "latest_model_dict.pt" in os.listdir(self.log_dir):
                 mu_net = ray.get(memory.load_model.remote(self.log_dir, mu_net))
                 # mu_net = load_model(self.log_dir, mu_net, self.config)
                 mu_net.to(device=self.device)
 
             # No point reanalysing until there are multiple games in the history
             while True:
-                buffer_len = ray.get(buffer.get_buffer_len.remote())
-                train_stats = ray.get(memory.get_data.remote())
+                buffer_len = buffer.get_buffer_len()
+                train_stats = self.counters
                 current_game = train_stats["games"]
                 if buffer_len >= 1 and current_game >= 2:
                     break
 
                 time.sleep(1)
 
-            mu_net.train()
-            mu_net = mu_net.to(self.device)
+            if local_model:
+                mu_net.train()
+                mu_net = mu_net.to(self.device)
 
-            p = ray.get(buffer.get_reanalyse_probabilities.remote())
+            ndxs, p = buffer.get_reanalyse_probabilities()
 
             if len(p) > 0:
-                ndxs = ray.get(buffer.get_buffer_ndxs.remote())
                 try:
                     ndx = np.random.choice(ndxs, p=p)
                 except ValueError:
                     print(p, ndxs)
-                game_rec = ray.get(buffer.get_buffer_ndx.remote(ndx))
+                observations = buffer.get_observations(ndx)
                 minmax = ray.get(memory.get_minmax.remote())
 
-                vals = game_rec.values
-
-                for i in range(len(game_rec.observations) - 1):
-                    if self.config["obs_type"] == "image":
-                        obs = game_rec.get_last_n(pos=i)
-                    else:
-                        obs = convert_from_int(
-                            game_rec.observations[i], self.config["obs_type"]
-                        )
-
-                    new_root = search(
+                # Every position of the game is searched at once, in chunks of reanalyse_batch_size trees
+                vals = [0.0] * len(observations)
+                search_stats = [None] * len(observations)
+                batch_size = self.config["reanalyse_batch_size"]
+                for start in range(0, len(observations), batch_size):
+                    new_roots = search_batch(
                         config=self.config,
                         mu_net=mu_net,
-                        current_frame=obs,
+                        frames=observations[start : start + batch_size],
                         minmax=minmax,
                         device=torch.device("cpu"),
                     )
-                    vals[i] = new_root.average_val
+                    for i, new_root in enumerate(new_roots, start):
+                        search_stats[i], vals[i] = root_stats(self.config, new_root)
 
-                buffer.update_vals.remote(ndx=ndx, vals=vals)
-                buffer.add_priorities.remote(ndx=ndx, reanalysing=True)
+                # This also sets the priorities of the steps of the game from their new values
+                buffer.update_vals(ndx=ndx, vals=vals, search_stats=search_stats)
                 print(f"Reanalysed game {ndx}")
             else:
                 time.sleep(5)
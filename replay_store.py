@@ -0,0 +1,210 @@
+import numpy as np
+
+from memory import GameRecord
+from utils import convert_from_int
+
+
+class ReplayStore:
+    """
+    Holds the steps of the games in the buffer as columns, one preallocated numpy array per field.
+    The row of a step is its global index modulo the capacity, so the steps of a game are contiguous
+    (wrapping around the end of the arrays), and the targets of a batch are gathered by fancy indexing.
+
+    The arrays are allocated when the first game is added, as the shape of the observations is only known then.
+    """
+
+    def __init__(self, config, capacity):
+        self.config = config
+        self.capacity = capacity
+        self.nec = config["exp_name"] == "cartpole-nec"
+        self.reward_depth = config["reward_depth"]  # Depth of the value targets which are cached
+        self.allocated = False
+
+    def allocate(self, game):
+        first_obs = game.observations[0][0] if self.nec else game.observations[0]
+        self.observations = np.zeros((self.capacity, *first_obs.shape), dtype=first_obs.dtype)
+        if self.nec:
+            self.renders = np.empty(self.capacity, dtype=object)
+
+        if self.config["obs_type"] == "bipedalwalker":
+            self.actions = np.zeros((self.capacity, self.config["action_dim"]), dtype=np.int64)
+        else:
+            self.actions = np.zeros(self.capacity, dtype=np.int64)
+        self.rewards = np.zeros(self.capacity)
+        # The discounted sum of the rewards from each step to the end of its game
+        self.discounted_returns = np.zeros(self.capacity)
+        self.values = np.zeros(self.capacity)
+        # The value targets for reward_depth, kept up to date whenever the values of a game are set
+        self.value_targets = np.zeros(self.capacity)
+        # The policy targets, the search stats normalised when they are stored, always having
+        # an action dimension, even when there is only one
+        self.policies = np.zeros(
+            (self.capacity, self.config["action_dim"], self.config["action_size"]), dtype=np.float32
+        )
+        self.priorities = np.zeros(self.capacity)
+        self.allocated = True
+
+    def rows(self, steps):
+        return np.asarray(steps) % self.capacity
+
+    def add_game(self, start, game):
+        """Writes the steps of a GameRecord to the rows of the global indices from start"""
+        if not self.allocated:
+            self.allocate(game)
+
+        length = len(game.values)
+        rows = self.rows(np.arange(start, start + length))
+        # The GameRecord also has the observation after the last step, which is never trained on
+        observations = game.observations[:length]
+        if self.nec:
+            self.observations[rows] = np.stack([obs[0] for obs in observations])
+            for row, obs in zip(rows, observations):
+                self.renders[row] = obs[1]
+        else:
+            self.observations[rows] = np.stack(observations)
+
+        self.actions[rows] = np.array(game.actions)
+        self.rewards[rows] = game.rewards
+        self.discounted_returns[rows] = discounted_returns(game.rewards, self.config["discount"])
+        self.set_values(rows, game.values, game.search_stats)
+        self.priorities[rows] = game.priorities
+
+    def set_values(self, rows, values, search_stats=None):
+        # rows are those of a whole game, as the value targets of a step depend on the values later in its game
+        self.values[rows] = values
+        self.cache_value_targets(rows)
+        if search_stats is not None:
+            search_stats = np.reshape(search_stats, (len(rows), *self.policies.shape[1:]))
+            # Visits are counted for every dimension, so the total of the first is the number of searches
+            total_searches = search_stats[:, 0].sum(axis=-1)
+            self.policies[rows] = search_stats / total_searches[:, None, None]
+
+    def cache_value_targets(self, rows):
+        # The discounted rewards up to reward_depth steps ahead are the difference between the discounted returns
+        # from the step and from reward_depth steps later, which is also where the value is bootstrapped from,
+        # if the game hasn't ended by then
+        discount = self.config["discount"]
+        value_targets = self.discounted_returns[rows]
+        bootstrap_rows = rows[self.reward_depth :]
+        value_targets[: len(bootstrap_rows)] += discount**self.reward_depth * (
+            self.values[bootstrap_rows] - self.discounted_returns[bootstrap_rows]
+        )
+        self.value_targets[rows] = value_targets
+
+    def get_observations(self, steps, starts):
+        """
+        The observations of the steps as taken by the network, where starts are the global indices of the first
+        step of their games, so that the frames stacked for image games don't reach back into the game before
+        """
+        steps = np.asarray(steps)
+        if self.config["obs_type"] == "image":
+            return self.stack_frames(steps, np.asarray(starts))
+        return convert_from_int(self.observations[self.rows(steps)], self.config["obs_type"])
+
+    def stack_frames(self, steps, starts):
+        # As in GameRecord.get_last_n, the last_n_frames frames up to each step follow a plane
+        # for each of their actions, with frames before the start of the game left as zeros
+        n = self.config["last_n_frames"]
+        frame_steps = steps[..., None] + np.arange(1 - n, 1)
+        in_game = frame_steps >= starts[..., None]
+        rows = self.rows(frame_steps)
+
+        frames = self.observations[rows]
+        frames[~in_game] = 0
+        frames = convert_from_int(frames, "image")
+        frames = frames.reshape(*steps.shape, -1, *frames.shape[-2:])
+
+        actions = np.where(in_game, self.actions[rows] + 1, 0) / self.config["action_size"]
+        action_planes = np.broadcast_to(
+            actions[..., None, None].astype(np.float32), (*actions.shape, *frames.shape[-2:])
+        )
+        return np.concatenate((action_planes, frames), axis=-3)
+
+    def make_targets(self, steps, starts, lengths, reward_depth=5, rollout_depth=3):
+        """
+        The batched equivalent of GameRecord.make_target, for steps with the given starts and lengths
+        of their games. Rollout steps beyond the end of a game are left as zeros
+        """
+        steps, starts, lengths = np.asarray(steps), np.asarray(starts), np.asarray(lengths)
+        discount = self.config["discount"]
+
+        # Position in the game of each step of the rollout, of shape (batch, rollout_depth)
+        positions = (steps - starts)[:, None] + np.arange(rollout_depth)
+        depths = np.minimum(rollout_depth, lengths - (steps - starts))
+        in_rollout = positions < lengths[:, None]
+        rollout_steps = starts[:, None] + positions
+        rows = self.rows(rollout_steps)
+
+        rewards = np.where(in_rollout, self.rewards[rows], 0)
+        if self.config["value_prefix"]:
+            target_rewards = np.cumsum(rewards, axis=1)
+        else:
+            target_rewards = rewards
+
+        if reward_depth == self.reward_depth:
+            target_values = self.value_targets[rows]
+        else:
+            # As in cache_value_targets, for another depth
+            bootstrap_rows = self.rows(rollout_steps + reward_depth)
+            target_values = self.discounted_returns[rows] + discount**reward_depth * np.where(
+                positions + reward_depth < lengths[:, None],
+                self.values[bootstrap_rows] - self.discounted_returns[bootstrap_rows],
+                0,
+            )
+        target_values = np.where(in_rollout, target_values, 0)
+        target_rewards = np.where(in_rollout, target_rewards, 0)
+
+        target_policies = self.policies[rows]
+        target_policies[~in_rollout] = 0
+        if self.config["action_dim"] == 1:
+            target_policies = target_policies[..., 0, :]
+
+        actions = self.actions[rows]
+        actions[~in_rollout] = 0
+
+        images = self.get_observations(rollout_steps, starts[:, None])
+        images[~in_rollout] = 0
+        if self.nec:
+            renders = [list(self.renders[rows[i, :depth]]) for i, depth in enumerate(depths)]
+            images = (images, renders)
+
+        return images, actions, target_values, target_rewards, target_policies, depths
+
+    def game_record(self, start, length, last_analysed=0):
+        """Rebuilds the GameRecord of the game of length steps from start, without its final observation"""
+        rows = self.rows(np.arange(start, start + length))
+        observations = self.observations[rows]
+        if self.nec:
+            observations = [(obs, render) for obs, render in zip(observations, self.renders[rows])]
+        elif self.config["obs_type"] != "image":
+            # Only image games keep their frames as one array
+            observations = list(observations)
+
+        game = GameRecord(
+            config=self.config,
+            action_size=self.config["action_size"],
+            init_frame=None,
+            discount=self.config["discount"],
+            last_analysed=last_analysed,
+        )
+        game.observations = observations
+        game.actions = self.actions[rows].tolist()
+        game.rewards = self.rewards[rows].tolist()
+        game.values = self.values[rows].tolist()
+        # The search stats are only kept normalised, which gives the same policy targets
+        if self.config["action_dim"] > 1:
+            game.search_stats = self.policies[rows].tolist()
+        else:
+            game.search_stats = self.policies[rows, 0].tolist()
+        game.priorities = self.priorities[rows].tolist()
+        return game
+
+
+def discounted_returns(rewards, discount):
+    """The discounted sum of the rewards from each step of a game to its end, S[t] = r[t] + discount * S[t + 1]"""
+    returns = np.zeros(len(rewards))
+    total = 0.0
+    for t in reversed(range(len(rewards))):
+        total = rewards[t] + discount * total
+        returns[t] = total
+    return returns
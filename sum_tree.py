@@ -0,0 +1,51 @@
+import numpy as np
+
+
+class SumTree:
+    """
+    Binary tree where every node holds the sum of its two children, used to sample the steps of
+    the buffer in proportion to their priority. Leaves are updated, and values are looked up,
+    in batches, each costing O(log n) per item.
+
+    The tree is stored as an array: node 1 is the root, the children of node i are 2i and 2i + 1,
+    and the leaves are nodes capacity to 2 * capacity - 1, with capacity rounded up to a power of 2.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = 1 << max(0, int(capacity - 1).bit_length())
+        self.depth = self.capacity.bit_length() - 1
+        self.nodes = np.zeros(2 * self.capacity)
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, leaves):
+        return self.nodes[np.asarray(leaves) + self.capacity]
+
+    def update(self, leaves, values):
+        """Sets the value of each of leaves, updating the sums of all of their ancestors"""
+        ndxs = np.asarray(leaves, dtype=np.int64) + self.capacity
+        if len(ndxs) == 0:
+            return
+        self.nodes[ndxs] = values
+        # Each level of ancestors is recomputed from its children, so rounding errors don't build up
+        for _ in range(self.depth):
+            ndxs = np.unique(ndxs // 2)
+            self.nodes[ndxs] = self.nodes[2 * ndxs] + self.nodes[2 * ndxs + 1]
+
+    def find(self, values):
+        """
+        For each of values, between 0 and total(), finds the leaf at which the cumulative sum
+        of the leaves goes past that value, so uniform values give leaves in proportion to their value.
+        A leaf of value 0 is never found while the total isn't 0, values past the total, from rounding,
+        giving the last leaf which isn't 0
+        """
+        values = np.array(values, dtype=np.float64)
+        ndxs = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * ndxs
+            # Subtrees summing to 0 are never entered, even if rounding leaves the value past the left subtree
+            go_right = ((values >= self.nodes[left]) & (self.nodes[left + 1] > 0)) | (self.nodes[left] <= 0)
+            values = np.where(go_right, values - self.nodes[left], values)
+            ndxs = np.where(go_right, left + 1, left)
+        return ndxs - self.capacity
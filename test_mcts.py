@@ -1,9 +1,283 @@
 import unittest
 
+import numpy as np
+import torch
+from torch import nn
+
+from memory import GameRecord
+from mcts import MinMax, SearchTree, considered_visits, search, search_batch
+from models import MuZeroInference, get_support_transform, scalar_to_support, support_to_scalar
+from replay_store import ReplayStore
+from sum_tree import SumTree
+
+
+SEARCH_CONFIG = {
+    "obs_type": "cartpole",
+    "nec": False,
+    "debug": False,
+    "check_supports": False,
+    "train_speed_profiling": False,
+    "support_width": 10,
+    "discount": 0.99,
+    "value_prefix": False,
+    "lstm_hidden_size": 16,
+    "n_simulations": 20,
+    "leaf_batch_size": 1,
+    "adaptive_search": False,
+    "min_simulations": 10,
+    "adaptive_share_tol": 0.02,
+    "adaptive_patience": 5,
+    "root_dirichlet_alpha": 0.3,
+    "explore_frac": 0.25,
+    "sampled_actions": 0,
+    "widening_factor": 0,
+    "widening_exponent": 0.5,
+    "gumbel_root": False,
+    "gumbel_top_k": 16,
+    "gumbel_c_visit": 50,
+    "gumbel_c_scale": 1.0,
+}
+
+
+class TinyNet(MuZeroInference, nn.Module):
+    """A small deterministic network with the interface search expects"""
+
+    def __init__(self, config, action_size=3, obs_size=4, latent_size=8):
+        super().__init__()
+        torch.manual_seed(0)
+        self.config = config
+        self.action_size = action_size
+        self.action_dim = 1
+        support_size = 2 * config["support_width"] + 1
+        self.repr_net = nn.Linear(obs_size, latent_size)
+        self.dyna_net = nn.Linear(latent_size + action_size, latent_size)
+        self.reward_net = nn.Linear(latent_size, support_size)
+        self.policy_net = nn.Linear(latent_size, action_size)
+        self.value_net = nn.Linear(latent_size, support_size)
+
+    def represent(self, observation):
+        return torch.tanh(self.repr_net(observation.to(dtype=torch.float32)))
+
+    def dynamics(self, latent, action):
+        new_latent = torch.tanh(self.dyna_net(torch.cat((latent, action.to(dtype=torch.float32)), dim=1)))
+        return new_latent, self.reward_net(new_latent)
+
+    def predict(self, latent):
+        return self.policy_net(latent), self.value_net(latent)
+
+
+FRAMES = [np.array([0.1, -0.2, 0.3, 0.05], dtype=np.float32), np.array([-0.4, 0.2, 0.0, 0.3], dtype=np.float32)]
+
+
+def run_search(config, batch=False):
+    np.random.seed(0)
+    mu_net = TinyNet(config)
+    if batch:
+        return search_batch(config, mu_net, FRAMES, MinMax())
+    return search(config, mu_net, FRAMES[0], MinMax())
+
+
+class FakeRoot:
+    """Stands in for the SearchTree given to GameRecord.add_step"""
+
+    def __init__(self, visits, value):
+        self.visits = visits
+        self.average_val = value
+
+    def search_policy(self):
+        return self.visits[None]
+
+
+def make_game(config, length, seed=0):
+    rng = np.random.default_rng(seed)
+    game = GameRecord(config, config["action_size"], rng.uniform(-1, 1, 4), discount=config["discount"])
+    for _ in range(length):
+        game.add_step(
+            rng.uniform(-1, 1, 4),
+            int(rng.integers(config["action_size"])),
+            float(rng.integers(3)),
+            FakeRoot(rng.integers(1, 10, config["action_size"]), rng.normal()),
+        )
+    game.add_priorities(n_steps=config["reward_depth"])
+    return game
+
+
+def make_tree(capacity=10):
+    mu_net = TinyNet(SEARCH_CONFIG)
+    return SearchTree(mu_net=mu_net, minmax=MinMax(), capacity=capacity, latent_shape=(8,))
+
 
 class TestMCTS(unittest.TestCase):
     def test_support2scalar(self):
-        pass
+        scalars = torch.tensor([-30.0, -1.5, 0.0, 0.3, 12.0])
+        supports = scalar_to_support(scalars, half_width=25)
+        self.assertEqual(supports.shape, (5, 51))
+        self.assertTrue(torch.allclose(supports.sum(dim=1), torch.ones(5)))
+        self.assertTrue(torch.allclose(support_to_scalar(supports), scalars, rtol=1e-3, atol=1e-2))
+
+        # A single support or scalar is converted without a batch dimension
+        self.assertTrue(torch.allclose(support_to_scalar(supports[1]), scalars[1], rtol=1e-3, atol=1e-2))
+        self.assertEqual(scalar_to_support(scalars[2], half_width=25).shape, (51,))
+
+    def test_support_transform_cache(self):
+        transform = get_support_transform(25, torch.device("cpu"))
+        self.assertIs(transform, get_support_transform(25, torch.device("cpu")))
+        self.assertIsNot(transform, get_support_transform(10, torch.device("cpu")))
+
+        checked = get_support_transform(25, torch.device("cpu"), check=True)
+        with self.assertRaises(ValueError):
+            checked.to_scalar(torch.ones(2, 51))
+
+    def test_subtree_root_value(self):
+        # A root reused by subtree should have the value of a fresh root given the same backups
+        latent, prior = torch.zeros(8), [1 / 3] * 3
+        discount = SEARCH_CONFIG["discount"]
+        tree = make_tree()
+        tree.add_root(latent, val_pred=0.3, prior=prior)
+        child = tree.insert(0, 1, latent, val_pred=0.5, prior=prior, reward=2.0)
+        tree.backpropagate([0], 0.5, discount)
+        tree.insert(child, 0, latent, val_pred=0.7, prior=prior, reward=1.0)
+        tree.backpropagate([0, child], 0.7, discount)
+        reused = tree.subtree(1)
+
+        fresh = make_tree()
+        fresh.add_root(latent, val_pred=0.5, prior=prior)
+        fresh.insert(0, 0, latent, val_pred=0.7, prior=prior, reward=1.0)
+        fresh.backpropagate([0], 0.7, discount)
+
+        for search_tree in (reused, fresh):
+            search_tree.insert(0, 2, latent, val_pred=-0.4, prior=prior, reward=0.5)
+            search_tree.backpropagate([0], -0.4, discount)
+        self.assertEqual(reused.rewards[0], 0)
+        self.assertEqual(reused.visit_counts[0], fresh.visit_counts[0])
+        self.assertAlmostEqual(reused.average_val, fresh.average_val)
+
+    def test_search_batch(self):
+        tree = run_search(SEARCH_CONFIG)
+        np.random.seed(0)
+        batch_tree = search_batch(SEARCH_CONFIG, TinyNet(SEARCH_CONFIG), FRAMES[:1], MinMax())[0]
+        self.assertEqual(tree.n_nodes, batch_tree.n_nodes)
+        self.assertTrue(np.array_equal(tree.children, batch_tree.children))
+        self.assertTrue(np.array_equal(tree.visit_counts, batch_tree.visit_counts))
+        self.assertTrue(np.allclose(tree.average_vals, batch_tree.average_vals))
+
+        # Every simulation of every tree in lockstep adds a node and a visit to its root
+        n_simulations = SEARCH_CONFIG["n_simulations"]
+        for tree in run_search(SEARCH_CONFIG, batch=True):
+            self.assertEqual(tree.n_nodes, n_simulations + 1)
+            self.assertEqual(tree.visit_counts[0], n_simulations)
+            self.assertEqual(tree.child_visits().sum(), n_simulations)
+
+    def test_virtual_loss(self):
+        config = dict(SEARCH_CONFIG, leaf_batch_size=4)
+        for tree in run_search(config, batch=True):
+            self.assertFalse(tree.virtual_losses.any())
+            # Simulations which were dropped for expanding the same leaf as another don't count as visits
+            self.assertEqual(tree.visit_counts[0], tree.n_nodes - 1)
+            self.assertEqual(tree.child_visits().sum(), tree.n_nodes - 1)
+
+    def test_subtree_keeps_nodes(self):
+        tree = run_search(SEARCH_CONFIG)
+        action = int(np.argmax(tree.child_visits()))
+        reused = tree.subtree(action)
+        self.assertEqual(reused.visit_counts[0], tree.visit_counts[tree.children[0, action]] - 1)
+
+        # Walk both trees together, the nodes below the new root keeping their statistics and latents
+        pairs = [(tree.children[0, action], 0)]
+        n_kept = 0
+        while pairs:
+            old, new = pairs.pop()
+            n_kept += 1
+            if new != 0:
+                self.assertEqual(reused.visit_counts[new], tree.visit_counts[old])
+                self.assertEqual(reused.average_vals[new], tree.average_vals[old])
+                self.assertEqual(reused.rewards[new], tree.rewards[old])
+            self.assertEqual(reused.val_preds[new], tree.val_preds[old])
+            self.assertTrue(torch.equal(reused.latents[new], tree.latents[old]))
+            self.assertTrue(np.array_equal(reused.children[new] != -1, tree.children[old] != -1))
+            self.assertTrue((reused.parents[reused.children[new][reused.children[new] != -1]] == new).all())
+            pairs += [
+                (old_child, new_child)
+                for old_child, new_child in zip(tree.children[old], reused.children[new])
+                if old_child != -1
+            ]
+        self.assertEqual(n_kept, reused.n_nodes)
+
+    def test_considered_visits(self):
+        # The sequences of get_sequence_of_considered_visits in mctx
+        self.assertEqual(considered_visits(1, 5), (0, 1, 2, 3, 4))
+        self.assertEqual(considered_visits(2, 6), (0, 0, 1, 1, 2, 2))
+        self.assertEqual(considered_visits(4, 8), (0, 0, 0, 0, 1, 1, 2, 2))
+        self.assertEqual(considered_visits(3, 10), (0, 0, 0, 1, 1, 2, 2, 3, 3, 4))
+        self.assertEqual(considered_visits(16, 32), (0,) * 16 + (1,) * 8 + (2,) * 4 + (3,) * 4)
+
+    def test_improved_policy(self):
+        for sampled_actions in (0, 2):
+            config = dict(SEARCH_CONFIG, gumbel_root=True, sampled_actions=sampled_actions)
+            for tree in run_search(config, batch=True):
+                policy = tree.improved_policy()
+                self.assertAlmostEqual(policy.sum(), 1)
+                self.assertTrue((policy >= 0).all())
+                # Slots without a sampled action are not legal
+                if sampled_actions:
+                    self.assertTrue((policy[tree.slot_actions[0] == -1] == 0).all())
+
+    def test_sum_tree_sampling(self):
+        priorities = np.array([0.5, 0.0, 2.0, 1.0, 0.0, 0.0, 3.0, 0.25, 0.0, 0.0])
+        tree = SumTree(len(priorities))
+        tree.update(np.arange(len(priorities)), priorities)
+        self.assertAlmostEqual(tree.total(), priorities.sum())
+
+        rng = np.random.default_rng(0)
+        leaves = tree.find(rng.uniform(0, tree.total(), size=200_000))
+        frequencies = np.bincount(leaves, minlength=tree.capacity)[: len(priorities)] / len(leaves)
+        self.assertTrue(np.allclose(frequencies, priorities / priorities.sum(), atol=0.005))
+        self.assertFalse(np.isin(leaves, np.flatnonzero(priorities == 0)).any())
+
+        # Values at or just past the total, as rounding can give, land on the last leaf which isn't 0
+        self.assertTrue((tree.find([tree.total(), tree.total() * (1 + 1e-12)]) == 7).all())
+
+        # Zeroing leaves, as when a game is evicted, takes them out of the sampling
+        tree.update([2, 7], [0.0, 0.0])
+        leaves = tree.find(rng.uniform(0, tree.total(), size=10_000))
+        self.assertTrue(np.isin(leaves, [0, 3, 6]).all())
+        self.assertEqual(tree.find([tree.total()])[0], 6)
+
+    def test_replay_store_targets(self):
+        # The batched targets of ReplayStore match those of GameRecord.make_target, for every step of a game
+        # stored across the end of the store's rows, including the steps whose rollout goes past the end of the game
+        for value_prefix in (False, True):
+            config = {
+                "exp_name": "cartpole",
+                "obs_type": "cartpole",
+                "action_dim": 1,
+                "action_size": 3,
+                "discount": 0.9,
+                "reward_depth": 3,
+                "value_prefix": value_prefix,
+            }
+            length, start = 7, 15
+            game = make_game(config, length)
+            store = ReplayStore(config, capacity=20)
+            store.add_game(start, game)
+
+            def check_targets(reward_depth, rollout_depth=4):
+                steps = np.arange(start, start + length)
+                targets = store.make_targets(
+                    steps, np.full(length, start), np.full(length, length), reward_depth, rollout_depth
+                )
+                for ndx in range(length):
+                    expected = game.make_target(ndx, reward_depth, rollout_depth)
+                    for target, expected_target in zip(targets, expected):
+                        self.assertTrue(np.allclose(target[ndx], expected_target, atol=1e-6))
+
+            check_targets(reward_depth=3)
+            check_targets(reward_depth=2)
+
+            # Reanalysed values replace the stored ones, updating the cached value targets
+            game.values = np.random.default_rng(1).normal(size=length).tolist()
+            store.set_values(store.rows(np.arange(start, start + length)), game.values)
+            check_targets(reward_depth=3)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,8 @@ import datetime
 import os
 import pickle
 import time
+import warnings
+from collections import deque
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -11,12 +13,13 @@ import torch.nn as nn
 
 from torch.utils.tensorboard import SummaryWriter
 
+from memory import CounterSubscriber
 from models import scalar_to_support, support_to_scalar
 # from memory import save_model, load_model
 
 
-@ray.remote(max_restarts=-1)
-class Trainer:
+@ray.remote(max_restarts=-1, max_concurrency=2)
+class Trainer(CounterSubscriber):
     def __init__(self):
         self.last_time = datetime.datetime.now()
 
@@ -42,19 +45,21 @@ class Trainer:
         self.config = config
         torch.autograd.set_detect_anomaly(True)
         self.writer = SummaryWriter(log_dir=log_dir)
-        next_batch = None
-        total_batches = ray.get(memory.get_data.remote())["batches"]
+        # Batches requested from the buffer, oldest first, prefetch_batches being kept in flight
+        # so that the buffer builds them while the trainer is training on earlier ones
+        batch_queue = deque()
+        total_batches = self.counters["batches"]
         if "latest_model_dict.pt" in os.listdir(log_dir):
             mu_net = ray.get(memory.load_model.remote(log_dir, mu_net))
             # mu_net = load_model(log_dir, mu_net, self.config)
         mu_net.to(device)
 
-        while ray.get(buffer.get_buffer_len.remote()) == 0:
+        while buffer.get_buffer_len() == 0:
             time.sleep(1)
         ms = time.time()
         metrics_dict = {}
 
-        while not ray.get(memory.is_finished.remote()):
+        while not self.counters["finished"]:
             self.print_timing("start")
             st = time.time()
 
@@ -65,10 +70,8 @@ class Trainer:
                 total_value_loss,
                 total_consistency_loss,
             ) = (0, 0, 0, 0, 0)
-            if not next_batch:
-                next_batch = buffer.get_batch.remote(
-                    batch_size=config["batch_size"], device=device
-                )
+            while len(batch_queue) < config["prefetch_batches"]:
+                batch_queue.append(buffer.request_batch(config["batch_size"]))
             self.print_timing("next batch command")
             #val_diff = 0
             mu_net.train()
@@ -80,6 +83,9 @@ class Trainer:
                 batch_consistency_loss,
             ) = (0, 0, 0, 0)
             self.print_timing("init")
+            # Whether the buffer is keeping up, from how many batches are ready and how long the trainer waits
+            ready_batches = sum(buffer.batch_ready(requests) for requests in batch_queue)
+            wait_start = time.time()
             (
                 images,
                 actions,
@@ -88,20 +94,24 @@ class Trainer:
                 target_policies,
                 weights,
                 depths,
-            ) = ray.get(next_batch)
-            next_batch = buffer.get_batch.remote(batch_size=config["batch_size"])
+                steps,
+            ) = buffer.get_batch(batch_queue.popleft())
+            batch_wait_time = time.time() - wait_start
+            batch_queue.append(buffer.request_batch(config["batch_size"]))
             self.print_timing("get batch")
 
+            # The batch arrives as numpy arrays in the object store, which are wrapped as tensors without copying
+            pin_memory = config["pin_batch_memory"] and device.type == "cuda"
             if self.config["exp_name"] == "cartpole-nec":
                 renders = images[1]
-                images = images[0].to(device=device)
+                images = batch_tensor(images[0], device, pin_memory)
             else:
-                images = images.to(device=device)
-            actions = actions.to(device=device)
-            target_rewards = target_rewards.to(device=device)
-            target_values = target_values.to(device=device)
-            target_policies = target_policies.to(device=device)
-            weights = weights.to(device=device)
+                images = batch_tensor(images, device, pin_memory)
+            actions = batch_tensor(actions, device, pin_memory)
+            target_rewards = batch_tensor(target_rewards, device, pin_memory)
+            target_values = batch_tensor(target_values, device, pin_memory)
+            target_policies = batch_tensor(target_policies, device, pin_memory)
+            weights = batch_tensor(weights, device, pin_memory)
             self.print_timing("changing to device")
 
             assert (
@@ -179,18 +189,26 @@ class Trainer:
                 # The muzero paper calculates the loss as the squared difference between scalars
                 # but CrossEntropyLoss is used here for a more stable value loss when large values are encountered
 
+                # The same cached support transform as used by search
+                support_transform = mu_net.support_transform(pred_reward_logits.device)
                 if self.config["nec"]:
                     pred_values = pred_value_logits[screen_t] 
                 else:
-                    pred_values = support_to_scalar(
+                    pred_values = support_transform.to_scalar(
                         torch.softmax(pred_value_logits[screen_t], dim=1)
                     )
                 
-                pred_rewards = support_to_scalar(
+                pred_rewards = support_transform.to_scalar(
                     torch.softmax(pred_reward_logits[screen_t], dim=1)
                 )
                 
                 self.print_timing("support to scalar")
+
+                if i == 0 and config["priority_replay"] and config["train_priorities"]:
+                    # The error of the value predicted from the first observation of each sample
+                    # becomes the new priority of the step it was sampled from
+                    value_errors = torch.abs(pred_values.reshape(-1) - target_value_step_i[screen_t]).detach()
+                    buffer.update_priorities(steps[screen_t.numpy()], value_errors.cpu().numpy())
                 vvar = torch.var(pred_rewards)
 
                 val_loss = torch.nn.MSELoss()
@@ -270,9 +288,11 @@ class Trainer:
                 "Loss/consistency": (
                     total_consistency_loss * config["consistency_weight"]
                 ),
+                "Replay/ready_batches": ready_batches,
+                "Replay/batch_wait_time": batch_wait_time,
             }
 
-            frames = ray.get(memory.get_data.remote())["frames"]
+            frames = self.counters["frames"]
             if total_batches % 50 == 0:
                 memory.save_model.remote(mu_net.to(device=torch.device("cpu")), log_dir)
                 # save_model(mu_net.to(device=torch.device("cpu")), log_dir, config)
@@ -306,8 +326,8 @@ class Trainer:
 
 
 def test_whole_game(mu_net, memory, buffer):
-    ndx = ray.get(buffer.get_buffer_ndxs.remote())[0]
-    game = ray.get(buffer.get_buffer_ndx.remote(ndx))
+    ndx = buffer.get_buffer_ndxs()[0]
+    game = buffer.get_buffer_ndx(ndx)
     for i in range(50):
         ims, acts, vals, rewards, _, _ = game.make_target(i, 5, 5)
 
@@ -338,14 +358,28 @@ def get_test_graph(mu_net, memory, discrete=False):
     plt.ylim(0, 6)
 
 
+def batch_tensor(array, device, pin_memory=False):
+    """
+    Wraps an array of a batch as a tensor on device. Arrays from the object store are read-only,
+    which torch warns about, but the batch is never written to. With pin_memory the array is first copied
+    to pinned memory, so that the copy to the gpu can run asynchronously
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        tensor = torch.from_numpy(array)
+    if pin_memory:
+        tensor = tensor.pin_memory()
+    return tensor.to(device=device, non_blocking=pin_memory)
+
+
 def get_test_numbers(mu_net, i, discrete, memory, buffer):
     # if discrete:
     #     val = i
     #     shape = [4]
     #     obs = torch.full(shape, val, dtype=torch.float32).unsqueeze(0)
     # else:
-    ndx = ray.get(buffer.get_buffer_ndxs.remote())[10]
-    game = ray.get(buffer.get_buffer_ndx.remote(ndx))
+    ndx = buffer.get_buffer_ndxs()[10]
+    game = buffer.get_buffer_ndx(ndx)
     ims, acts, _, rewards, _, _ = game.make_target(21 + i, 5, 5)
 
     print(rewards[0], ims[0].shape, type(ims[0]))